@@ -13,21 +13,21 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
+
 from apiflask import APIFlask
 from dotenv import load_dotenv
 
-from derailedapi import ratelimiter
+# settings are read when modules are imported
+load_dotenv()
+
+from derailedapi import instrumentation, metrics, ratelimiter
+from derailedapi.channels.routes import channels
+from derailedapi.database import ensure_connected
 from derailedapi.json import ORJSONDecoder, ORJSONEncoder
 from derailedapi.relationships.routes import relationships
 from derailedapi.users.routes import registerr, users
 
-load_dotenv()
-
-from derailedapi.database import connect, sync_tables
-
-connect()
-sync_tables()
-
 app = APIFlask(
     __name__,
     title='Derailed API',
@@ -37,7 +37,11 @@ app = APIFlask(
     docs_path='/',
 )
 
+# workers connect after forking, gunicorn.conf.py does so eagerly
+app.before_request(ensure_connected)
 ratelimiter.limiter.init_app(app=app)
+instrumentation.init_app(app, limiter=ratelimiter.limiter)
+metrics.init_app(app, limiter=ratelimiter.limiter)
 app.config['INFO'] = {
     'description': 'The API for Derailed.',
     'termsOfService': 'https://derailed.one/terms',
@@ -50,15 +54,21 @@ app.config['INFO'] = {
 app.config['SERVERS'] = [
     {'name': 'Production', 'url': 'https://derailed.one/api'},
 ]
-app.tags = ['Users', 'Relationships']
+app.tags = ['Users', 'Relationships', 'Channels']
 app.json_encoder = ORJSONEncoder
 app.json_decoder = ORJSONDecoder
+# orjson keeps insertion order, sorting would only cost time
+app.config['JSON_SORT_KEYS'] = False
+app.config['JSON_SNOWFLAKES_AS_STR'] = os.getenv('JSON_SNOWFLAKES_AS_STR') == 'true'
+# endpoints dumped with compiled serializers instead of marshmallow
+app.config['FAST_SERIALIZERS'] = os.getenv('FAST_SERIALIZERS', '*')
 
 
 # register blueprints
 app.register_blueprint(registerr)
 app.register_blueprint(users)
 app.register_blueprint(relationships)
+app.register_blueprint(channels)
 ratelimiter.limiter.limit('2/hour')(registerr)
 
 
@@ -0,0 +1,972 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# An in-memory stand-in for a Scylla session.
+#
+# It understands the CQL cqlengine and `derailedapi.statements` send,
+# keeps tables in dicts keyed like the models in `derailedapi.database`,
+# and sleeps `latency` seconds per query, so routes can be measured
+# without a cluster. Queries sent with `execute_async` overlap, like they
+# would on a real cluster.
+#
+#   session = install(latency=0.001)
+#   ...
+#   session.queries  # statements executed so far
+import functools
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Iterator, Type
+
+from cassandra import InvalidRequest
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, ExecutionProfile, _ConfigMode
+from cassandra.cqlengine import columns, connection, models
+from cassandra.encoder import Encoder
+from cassandra.query import dict_factory, tuple_factory
+
+TOKEN = re.compile(
+    r'''\s*(?:
+    (?P<qname>"(?:[^"]|"")*")
+    |(?P<string>'(?:[^']|'')*')
+    |(?P<named>%\((?P<name>\w+)\)s)
+    |(?P<positional>%s|\?)
+    |(?P<number>-?\d+(?:\.\d+)?)
+    |(?P<word>[A-Za-z_]\w*)
+    |(?P<op><=|>=|!=|[=<>(),;*+\-\[\].])
+    )''',
+    re.X,
+)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class UnsupportedQuery(Exception):
+    """The statement uses CQL this stand-in does not implement."""
+
+
+# ---- parsing
+
+
+@dataclass(frozen=True)
+class Param:
+    key: int | str
+
+
+@dataclass(frozen=True)
+class Column:
+    name: str
+
+
+@dataclass
+class Condition:
+    column: str
+    op: str
+    value: Any
+
+
+@dataclass
+class Select:
+    table: str
+    columns: list[str] | None
+    where: list[Condition]
+    count: bool = False
+    order: tuple[str, str] | None = None
+    limit: Any = None
+
+
+@dataclass
+class Insert:
+    table: str
+    values: dict[str, Any]
+    if_not_exists: bool = False
+
+
+@dataclass
+class Update:
+    table: str
+    assignments: list[tuple[str, Any]]
+    where: list[Condition]
+    conditions: list[Condition] | None = None
+    if_exists: bool = False
+
+
+@dataclass
+class Delete:
+    table: str
+    columns: list[str]
+    where: list[Condition]
+    conditions: list[Condition] | None = None
+    if_exists: bool = False
+
+
+@dataclass
+class Batch:
+    statements: list[Any] = field(default_factory=list)
+
+
+class Parser:
+    def __init__(self, cql: str) -> None:
+        self.tokens: list[tuple[str, Any]] = []
+        self.pos = 0
+        positional = 0
+        end = len(cql.rstrip())
+        index = 0
+
+        while index < end:
+            match = TOKEN.match(cql, index)
+
+            if match is None or match.end() == index:
+                raise UnsupportedQuery(f'cannot tokenize {cql[index:]!r}')
+
+            index = match.end()
+            kind = match.lastgroup
+
+            if kind == 'qname':
+                self.tokens.append(('name', match['qname'][1:-1].replace('""', '"')))
+            elif kind == 'word':
+                self.tokens.append(('word', match['word']))
+            elif kind == 'string':
+                self.tokens.append(('value', match['string'][1:-1].replace("''", "'")))
+            elif kind == 'number':
+                number = match['number']
+                self.tokens.append(
+                    ('value', float(number) if '.' in number else int(number))
+                )
+            elif kind == 'named':
+                self.tokens.append(('value', Param(match['name'])))
+            elif kind == 'positional':
+                self.tokens.append(('value', Param(positional)))
+                positional += 1
+            else:
+                self.tokens.append(('op', match['op']))
+
+    def peek(self, offset: int = 0) -> tuple[str, Any]:
+        try:
+            return self.tokens[self.pos + offset]
+        except IndexError:
+            return ('end', None)
+
+    def keyword(self, *words: str) -> bool:
+        for offset, word in enumerate(words):
+            kind, value = self.peek(offset)
+
+            if kind != 'word' or value.upper() != word:
+                return False
+
+        self.pos += len(words)
+        return True
+
+    def expect(self, *words: str) -> None:
+        if not self.keyword(*words):
+            raise UnsupportedQuery(f'expected {" ".join(words)} at {self.peek()}')
+
+    def op(self, symbol: str) -> bool:
+        if self.peek() == ('op', symbol):
+            self.pos += 1
+            return True
+
+        return False
+
+    def name(self) -> str:
+        kind, value = self.peek()
+
+        if kind not in ('name', 'word'):
+            raise UnsupportedQuery(f'expected a name at {self.peek()}')
+
+        self.pos += 1
+        # unquoted names are case-insensitive
+        return value if kind == 'name' else value.lower()
+
+    def table(self) -> str:
+        name = self.name()
+
+        if self.op('.'):
+            name = self.name()
+
+        return name
+
+    def value(self) -> Any:
+        kind, value = self.peek()
+
+        if kind == 'value':
+            self.pos += 1
+            return value
+
+        if self.op('('):
+            values = [self.value()]
+
+            while self.op(','):
+                values.append(self.value())
+
+            self.op(')')
+            return tuple(values)
+
+        if kind == 'word' and value.upper() in ('TRUE', 'FALSE', 'NULL'):
+            self.pos += 1
+            return {'TRUE': True, 'FALSE': False, 'NULL': None}[value.upper()]
+
+        raise UnsupportedQuery(f'expected a value at {self.peek()}')
+
+    def term(self) -> Any:
+        if self.peek()[0] in ('name', 'word') and self.peek()[1].upper() not in (
+            'TRUE',
+            'FALSE',
+            'NULL',
+        ):
+            return Column(self.name())
+
+        return self.value()
+
+    def conditions(self) -> list[Condition]:
+        conditions = []
+
+        while True:
+            if self.peek(1) == ('op', '('):
+                raise UnsupportedQuery('token() restrictions are not supported')
+
+            column = self.name()
+
+            if self.keyword('IN'):
+                op = 'IN'
+            else:
+                kind, op = self.peek()
+
+                if kind != 'op':
+                    raise UnsupportedQuery(f'expected an operator at {self.peek()}')
+
+                self.pos += 1
+
+            conditions.append(Condition(column, op, self.value()))
+
+            if not self.keyword('AND'):
+                return conditions
+
+    def using(self) -> None:
+        if self.keyword('USING'):
+            while True:
+                self.name()
+                self.value()
+
+                if not self.keyword('AND'):
+                    break
+
+    def lwt(self, statement: Update | Delete) -> None:
+        if self.keyword('IF', 'EXISTS'):
+            statement.if_exists = True
+        elif self.keyword('IF'):
+            statement.conditions = self.conditions()
+
+    def statement(self) -> Any:
+        if self.keyword('SELECT'):
+            return self.select()
+        if self.keyword('INSERT', 'INTO'):
+            return self.insert()
+        if self.keyword('UPDATE'):
+            return self.update()
+        if self.keyword('DELETE'):
+            return self.delete()
+        if self.keyword('BEGIN'):
+            return self.batch()
+
+        raise UnsupportedQuery(f'unsupported statement at {self.peek()}')
+
+    def select(self) -> Select:
+        self.keyword('DISTINCT')
+        count = False
+        selected: list[str] | None = []
+
+        if self.keyword('COUNT'):
+            self.op('(')
+            self.op('*') or self.name()
+            self.op(')')
+            count = True
+        elif self.op('*'):
+            selected = None
+        else:
+            selected.append(self.name())
+
+            while self.op(','):
+                selected.append(self.name())
+
+        self.expect('FROM')
+        statement = Select(self.table(), None if count else selected, [], count)
+
+        if self.keyword('WHERE'):
+            statement.where = self.conditions()
+
+        if self.keyword('ORDER', 'BY'):
+            column = self.name()
+            direction = 'DESC' if self.keyword('DESC') else 'ASC'
+            self.keyword('ASC')
+            statement.order = (column, direction)
+
+        if self.keyword('LIMIT'):
+            statement.limit = self.value()
+
+        self.keyword('ALLOW', 'FILTERING')
+        return statement
+
+    def insert(self) -> Insert:
+        table = self.table()
+        names = []
+        self.op('(')
+        names.append(self.name())
+
+        while self.op(','):
+            names.append(self.name())
+
+        self.op(')')
+        self.expect('VALUES')
+        values = self.value()
+        statement = Insert(table, dict(zip(names, values)))
+
+        if self.keyword('IF', 'NOT', 'EXISTS'):
+            statement.if_not_exists = True
+
+        self.using()
+        return statement
+
+    def update(self) -> Update:
+        table = self.table()
+        self.using()
+        self.expect('SET')
+        assignments = []
+
+        while True:
+            column = self.name()
+
+            if self.op('['):
+                raise UnsupportedQuery('map item assignments are not supported')
+
+            self.op('=') or self._fail('=')
+            expression = [self.term()]
+
+            while self.peek() in (('op', '+'), ('op', '-')):
+                expression.append(self.peek()[1])
+                self.pos += 1
+                expression.append(self.term())
+
+            assignments.append((column, expression))
+
+            if not self.op(','):
+                break
+
+        self.expect('WHERE')
+        statement = Update(table, assignments, self.conditions())
+        self.lwt(statement)
+        return statement
+
+    def delete(self) -> Delete:
+        names = []
+
+        if not self.keyword('FROM'):
+            names.append(self.name())
+
+            while self.op(','):
+                names.append(self.name())
+
+            self.expect('FROM')
+
+        table = self.table()
+        self.using()
+        self.expect('WHERE')
+        statement = Delete(table, names, self.conditions())
+        self.lwt(statement)
+        return statement
+
+    def batch(self) -> Batch:
+        self.keyword('UNLOGGED') or self.keyword('COUNTER') or self.keyword('LOGGED')
+        self.expect('BATCH')
+        self.using()
+        batch = Batch()
+
+        while not self.keyword('APPLY', 'BATCH'):
+            batch.statements.append(self.statement())
+            self.op(';')
+
+        self.op(';')
+        return batch
+
+    def _fail(self, expected: str) -> None:
+        raise UnsupportedQuery(f'expected {expected} at {self.peek()}')
+
+    def parse(self) -> Any:
+        statement = self.statement()
+        self.op(';')
+
+        if self.peek()[0] != 'end':
+            raise UnsupportedQuery(f'unexpected {self.peek()}')
+
+        return statement
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(cql: str) -> Any:
+    return Parser(cql).parse()
+
+
+# ---- storage
+
+
+class Table:
+    """A model's rows, by partition key and then clustering key."""
+
+    def __init__(self, model: Type[models.Model]) -> None:
+        self.model = model
+        self.partition_keys = [c.db_field_name for c in model._partition_keys.values()]
+        self.clustering_keys = [
+            c.db_field_name for c in model._clustering_keys.values()
+        ]
+        self.descending = [
+            (c.clustering_order or 'ASC').upper() == 'DESC'
+            for c in model._clustering_keys.values()
+        ]
+        self.columns = [c.db_field_name for c in model._columns.values()]
+        self.counters = {
+            c.db_field_name
+            for c in model._columns.values()
+            if isinstance(c, columns.Counter)
+        }
+        # sent as milliseconds since the epoch, read back as datetimes
+        self.timestamps = {
+            c.db_field_name
+            for c in model._columns.values()
+            if isinstance(c, columns.DateTime)
+        }
+        self.indexes: dict[str, dict[Any, set[tuple]]] = {
+            c.db_field_name: {} for c in model._columns.values() if c.index
+        }
+        self.partitions: dict[tuple, dict[tuple, dict[str, Any]]] = {}
+
+    def _index(self, row: dict[str, Any], add: bool) -> None:
+        key = (
+            tuple(row[k] for k in self.partition_keys),
+            tuple(row[k] for k in self.clustering_keys),
+        )
+
+        for column, index in self.indexes.items():
+            value = row.get(column)
+
+            if value is None:
+                continue
+
+            if add:
+                index.setdefault(value, set()).add(key)
+            else:
+                index.get(value, set()).discard(key)
+
+    def get(self, partition: tuple, clustering: tuple) -> dict[str, Any] | None:
+        return self.partitions.get(partition, {}).get(clustering)
+
+    def put(self, partition: tuple, clustering: tuple, values: dict[str, Any]) -> None:
+        rows = self.partitions.setdefault(partition, {})
+        row = rows.get(clustering)
+
+        if row is None:
+            row = rows[clustering] = dict.fromkeys(self.columns)
+            row.update(zip(self.partition_keys, partition))
+            row.update(zip(self.clustering_keys, clustering))
+        else:
+            self._index(row, add=False)
+
+        row.update(values)
+
+        for column in self.timestamps & values.keys():
+            if isinstance(row[column], (int, float)):
+                row[column] = EPOCH + timedelta(milliseconds=row[column])
+
+        self._index(row, add=True)
+
+    def remove(self, partition: tuple, clustering: tuple | None) -> None:
+        rows = self.partitions.get(partition)
+
+        if rows is None:
+            return
+
+        targets = list(rows) if clustering is None else [clustering]
+
+        for key in targets:
+            row = rows.pop(key, None)
+
+            if row is not None:
+                self._index(row, add=False)
+
+        if not rows:
+            del self.partitions[partition]
+
+    def _sorted(self, rows: dict[tuple, dict[str, Any]]) -> list[dict[str, Any]]:
+        ordered = list(rows.values())
+
+        # stable sorts, last clustering key first
+        for name, descending in reversed(
+            list(zip(self.clustering_keys, self.descending))
+        ):
+            ordered.sort(key=lambda r: r[name], reverse=descending)
+
+        return ordered
+
+    def scan(self, where: list[Condition], params: Any) -> Iterator[dict[str, Any]]:
+        bound = [(c, resolve(c.value, params)) for c in where]
+        equal = {c.column: [v] for c, v in bound if c.op == '='}
+        equal.update({c.column: list(v) for c, v in bound if c.op == 'IN'})
+
+        if all(k in equal for k in self.partition_keys):
+            partitions = [()]
+
+            for key in self.partition_keys:
+                partitions = [p + (v,) for p in partitions for v in equal[key]]
+        else:
+            indexed = next((k for k in self.indexes if k in equal), None)
+
+            if indexed is not None:
+                partitions = list(
+                    dict.fromkeys(
+                        p
+                        for v in equal[indexed]
+                        for p, _ in self.indexes[indexed].get(v, ())
+                    )
+                )
+            else:
+                partitions = list(self.partitions)
+
+        for partition in partitions:
+            for row in self._sorted(self.partitions.get(partition, {})):
+                if all(matches(row.get(c.column), c.op, v) for c, v in bound):
+                    yield row
+
+
+def resolve(value: Any, params: Any) -> Any:
+    if isinstance(value, Param):
+        return params[value.key]
+
+    if isinstance(value, tuple):
+        return tuple(resolve(v, params) for v in value)
+
+    return value
+
+
+def matches(actual: Any, op: str, expected: Any) -> bool:
+    if op == 'IN':
+        return actual in expected
+
+    if op == '=':
+        return actual == expected
+
+    if op == '!=':
+        return actual != expected
+
+    if actual is None:
+        return False
+
+    return {
+        '<': actual < expected,
+        '<=': actual <= expected,
+        '>': actual > expected,
+        '>=': actual >= expected,
+    }[op]
+
+
+def combine(left: Any, op: str, right: Any) -> Any:
+    if left is None:
+        return right if op == '+' else left
+
+    if right is None:
+        return left
+
+    if isinstance(left, set):
+        return left | set(right) if op == '+' else left - set(right)
+
+    if isinstance(left, list):
+        return left + list(right) if op == '+' else [v for v in left if v not in right]
+
+    if isinstance(left, dict):
+        return {**left, **right}
+
+    return left + right if op == '+' else left - right
+
+
+# ---- session
+
+
+class Result:
+    """Just enough of `cassandra.cluster.ResultSet`."""
+
+    def __init__(
+        self,
+        rows: list[Any],
+        column_names: list[str] | None = None,
+        paging_state: bytes | None = None,
+        fetch_next: Any = None,
+    ) -> None:
+        self.current_rows = rows
+        self.column_names = column_names
+        self.paging_state = paging_state
+        self._fetch_next = fetch_next
+
+    @property
+    def has_more_pages(self) -> bool:
+        return self.paging_state is not None
+
+    @property
+    def was_applied(self) -> bool:
+        row = self.current_rows[0]
+        applied = row['[applied]'] if isinstance(row, dict) else row[0]
+        return bool(applied)
+
+    def one(self) -> Any:
+        return self.current_rows[0] if self.current_rows else None
+
+    def all(self) -> list[Any]:
+        return list(self)
+
+    def __iter__(self) -> Iterator[Any]:
+        page = self
+
+        # like the driver, iterating goes on to the following pages
+        while True:
+            yield from page.current_rows
+
+            if page.paging_state is None:
+                return
+
+            page = page._fetch_next()
+
+    def __bool__(self) -> bool:
+        return bool(self.current_rows)
+
+
+class Future:
+    """A query in flight, it completes ``latency`` after it was sent."""
+
+    def __init__(self, query: Any) -> None:
+        self.query = query
+        self._deadline = 0.0
+        self._outcome: Result | Exception | None = None
+        self._callbacks: list[tuple[Any, Any]] = []
+
+    def _complete(self, deadline: float, outcome: Result | Exception) -> None:
+        self._deadline = deadline
+        self._outcome = outcome
+
+    def result(self) -> Result:
+        delay = self._deadline - time.perf_counter()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        # nothing runs in the background, callbacks fire once it is awaited
+        callbacks, self._callbacks = self._callbacks, []
+
+        for callback, errback in callbacks:
+            if isinstance(self._outcome, Exception):
+                errback(self._outcome)
+            else:
+                callback(self._outcome)
+
+        if isinstance(self._outcome, Exception):
+            raise self._outcome
+
+        return self._outcome
+
+    def add_callbacks(self, callback, errback) -> None:
+        self._callbacks.append((callback, errback))
+
+
+class PreparedStatement:
+    def __init__(self, query_string: str) -> None:
+        self.query_string = query_string
+        self.fetch_size = None
+
+    def bind(self, values: Any) -> 'BoundStatement':
+        return BoundStatement(self, values)
+
+
+class BoundStatement:
+    def __init__(self, prepared_statement: PreparedStatement, values: Any) -> None:
+        self.prepared_statement = prepared_statement
+        self.query_string = prepared_statement.query_string
+        self.values = values
+        self.fetch_size = None
+
+
+class Cluster:
+    _config_mode = _ConfigMode.PROFILES
+    protocol_version = 4
+
+    def __init__(self) -> None:
+        self.profile_manager = type('Profiles', (), {})()
+        self.profile_manager.default = ExecutionProfile(row_factory=dict_factory)
+        self.metadata = None
+
+    def register_user_type(self, *args: Any) -> None:
+        pass
+
+
+class Session:
+    default_fetch_size = 5000
+
+    def __init__(self, tables: list[Type[models.Model]], latency: float = 0.0) -> None:
+        self.latency = latency
+        self.keyspace = models.DEFAULT_KEYSPACE
+        self.hosts: list[Any] = []
+        self.cluster = Cluster()
+        self.encoder = Encoder()
+        self.tables = {m.column_family_name(False): Table(m) for m in tables}
+        self.queries = 0
+        self._lock = threading.RLock()
+        self._listeners: list[tuple[Any, tuple]] = []
+
+    # driver api
+
+    def prepare(self, query: str) -> PreparedStatement:
+        parse(query)
+        return PreparedStatement(query)
+
+    def add_request_init_listener(self, fn: Any, *args: Any) -> None:
+        self._listeners.append((fn, args))
+
+    def execution_profile_clone_update(self, profile: Any, **kwargs: Any) -> Any:
+        return ExecutionProfile(**kwargs)
+
+    def execute(self, query: Any, parameters: Any = None, **kwargs: Any) -> Result:
+        return self.execute_async(query, parameters, **kwargs).result()
+
+    def execute_async(
+        self,
+        query: Any,
+        parameters: Any = None,
+        timeout: Any = None,
+        execution_profile: Any = EXEC_PROFILE_DEFAULT,
+        paging_state: bytes | None = None,
+        **kwargs: Any,
+    ) -> Future:
+        query_string = query if isinstance(query, str) else query.query_string
+
+        if parameters is None:
+            parameters = getattr(query, 'values', None)
+        fetch_size = getattr(query, 'fetch_size', None)
+
+        if not isinstance(fetch_size, int) or fetch_size <= 0:
+            fetch_size = self.default_fetch_size
+
+        tuples = getattr(execution_profile, 'row_factory', None) is tuple_factory
+        future = Future(query)
+
+        for fn, args in self._listeners:
+            fn(future, *args)
+
+        try:
+            outcome: Result | Exception = self._run(
+                parse(query_string), parameters or (), fetch_size, paging_state, tuples
+            )
+        except Exception as exc:
+            outcome = exc
+
+        future._complete(time.perf_counter() + self.latency, outcome)
+        return future
+
+    def get_pool_state(self) -> dict[Any, Any]:
+        return {}
+
+    def shutdown(self) -> None:
+        pass
+
+    # interpreter
+
+    def _table(self, name: str) -> Table:
+        try:
+            return self.tables[name]
+        except KeyError:
+            raise UnsupportedQuery(f'unknown table {name}') from None
+
+    def _run(
+        self,
+        statement: Any,
+        params: Any,
+        fetch_size: int,
+        paging_state: bytes | None,
+        tuples: bool,
+    ) -> Result:
+        with self._lock:
+            self.queries += 1
+
+            if isinstance(statement, Select):
+                return self._select(statement, params, fetch_size, paging_state, tuples)
+
+            if isinstance(statement, Batch):
+                results = [self._write(s, params) for s in statement.statements]
+                failed = next((r for r in results if r and not r['[applied]']), None)
+                return Result([failed] if failed else [])
+
+            row = self._write(statement, params)
+            return Result([row] if row is not None else [])
+
+    def _select(
+        self,
+        statement: Select,
+        params: Any,
+        fetch_size: int,
+        paging_state: bytes | None,
+        tuples: bool,
+    ) -> Result:
+        table = self._table(statement.table)
+        rows = list(table.scan(statement.where, params))
+
+        if statement.order is not None and table.clustering_keys:
+            column, direction = statement.order
+            index = table.clustering_keys.index(column)
+
+            if table.descending[index] != (direction == 'DESC'):
+                rows.reverse()
+
+        limit = resolve(statement.limit, params)
+
+        if limit is not None:
+            rows = rows[:limit]
+
+        if statement.count:
+            return Result([(len(rows),) if tuples else {'count': len(rows)}], ['count'])
+
+        names = statement.columns or table.columns
+        try:
+            start = int(paging_state or 0)
+        except ValueError:
+            raise InvalidRequest('Invalid value for the paging state') from None
+
+        page = rows[start : start + fetch_size]
+        more = start + fetch_size < len(rows)
+        next_state = str(start + fetch_size).encode() if more else None
+
+        if tuples:
+            page = [tuple(r[n] for n in names) for r in page]
+        else:
+            page = [{n: r[n] for n in names} for r in page]
+
+        def fetch_next() -> Result:
+            return self._run(statement, params, fetch_size, next_state, tuples)
+
+        return Result(page, list(names), next_state, fetch_next)
+
+    def _key(self, table: Table, where: list[Condition], params: Any):
+        values = {c.column: resolve(c.value, params) for c in where if c.op == '='}
+        partition = tuple(values[k] for k in table.partition_keys)
+        clustering = tuple(values.get(k) for k in table.clustering_keys)
+
+        if None in clustering:
+            clustering = None
+
+        return partition, clustering
+
+    def _check(
+        self,
+        existing: dict[str, Any] | None,
+        conditions: list[Condition] | None,
+        if_exists: bool,
+        params: Any,
+    ) -> dict[str, Any] | None:
+        """The LWT result row, None for statements without conditions."""
+        if conditions is None and not if_exists:
+            return None
+
+        if existing is None:
+            return {'[applied]': False}
+
+        applied = conditions is None or all(
+            matches(existing.get(c.column), c.op, resolve(c.value, params))
+            for c in conditions
+        )
+        return {'[applied]': applied, **({} if applied else existing)}
+
+    def _write(self, statement: Any, params: Any) -> dict[str, Any] | None:
+        table = self._table(statement.table)
+
+        if isinstance(statement, Insert):
+            values = {k: resolve(v, params) for k, v in statement.values.items()}
+            partition = tuple(values[k] for k in table.partition_keys)
+            clustering = tuple(values[k] for k in table.clustering_keys)
+            existing = table.get(partition, clustering)
+
+            if statement.if_not_exists and existing is not None:
+                return {'[applied]': False, **existing}
+
+            table.put(partition, clustering, values)
+            return {'[applied]': True} if statement.if_not_exists else None
+
+        partition, clustering = self._key(table, statement.where, params)
+        existing = table.get(partition, clustering) if clustering is not None else None
+        lwt = self._check(existing, statement.conditions, statement.if_exists, params)
+
+        if lwt is not None and not lwt['[applied]']:
+            return lwt
+
+        if isinstance(statement, Update):
+            values = {}
+
+            for column, expression in statement.assignments:
+                value = self._evaluate(expression[0], existing, params)
+
+                for i in range(1, len(expression), 2):
+                    right = self._evaluate(expression[i + 1], existing, params)
+                    value = combine(value, expression[i], right)
+
+                if column in table.counters and value is None:
+                    value = 0
+
+                values[column] = value
+
+            table.put(partition, clustering or (), values)
+        elif statement.columns:
+            if existing is not None:
+                table.put(partition, clustering, dict.fromkeys(statement.columns))
+        else:
+            table.remove(partition, clustering)
+
+        return lwt
+
+    def _evaluate(self, term: Any, row: dict[str, Any] | None, params: Any) -> Any:
+        if isinstance(term, Column):
+            return None if row is None else row.get(term.name)
+
+        return resolve(term, params)
+
+
+def database_models() -> list[Type[models.Model]]:
+    from derailedapi import database
+
+    return [
+        value
+        for value in vars(database).values()
+        if isinstance(value, type)
+        and issubclass(value, models.Model)
+        and value is not models.Model
+        and not value.__abstract__
+    ]
+
+
+def install(latency: float = 0.0) -> Session:
+    """Make cqlengine and `derailedapi` use a fresh in-memory session."""
+    from derailedapi import database
+    from derailedapi.instrumentation import instrument_session
+
+    session = Session(database_models(), latency=latency)
+    connection.register_connection('default', session=session, default=True)
+    instrument_session(session)
+    # `ensure_connected` would otherwise dial the real cluster
+    database._connected_pid = os.getpid()
+    return session
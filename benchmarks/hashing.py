@@ -0,0 +1,134 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Mixed login and GET /users/@me traffic in one gevent worker, with and
+# without HASH_OFFLOAD.
+#
+#   python -m benchmarks.hashing --logins 4 --readers 32 --seconds 5
+#
+# Every mode runs in its own process, HASH_OFFLOAD is read on import.
+# Without offload a login's argon2 call freezes the hub, so the reads
+# queued behind it wait for the whole hash.
+import argparse
+import os
+import subprocess
+import sys
+
+MODES = ('true', 'false')
+
+
+def run(args: argparse.Namespace) -> None:
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    import statistics
+    import time
+
+    import gevent
+
+    os.environ['HASH_OFFLOAD'] = args.offload
+    os.environ.setdefault('AUTH_KEY', 'benchmark')
+
+    from cassandra.cqlengine import models
+
+    from . import fakescylla
+    from .routes import Runner, percentile
+
+    models.DEFAULT_KEYSPACE = 'derailed'
+    session = fakescylla.install(latency=args.latency)
+
+    from app import app
+    from derailedapi.ratelimiter import limiter
+
+    # measuring the hub, not the limits
+    limiter.enabled = False
+    runner = Runner(app, session, seed=0)
+
+    for index in range(args.logins + args.readers):
+        runner.register(index)
+
+    deadline = time.perf_counter() + args.seconds
+    reads: list[float] = []
+    logins: list[float] = []
+    rejected = 0
+
+    def login(account) -> None:
+        nonlocal rejected
+        client = app.test_client()
+
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = client.post(
+                '/login', json={'email': account.email, 'password': account.password}
+            )
+            logins.append(time.perf_counter() - started)
+            rejected += response.status_code == 503
+
+    def read(account) -> None:
+        client = app.test_client()
+
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            client.get('/users/@me', headers={'Authorization': account.token})
+            reads.append(time.perf_counter() - started)
+
+    accounts = runner.accounts
+    gevent.joinall(
+        [gevent.spawn(login, a) for a in accounts[: args.logins]]
+        + [gevent.spawn(read, a) for a in accounts[args.logins :]]
+    )
+
+    print(
+        f'{args.offload:<9}{len(reads) / args.seconds:>9,.0f}'
+        f'{statistics.median(reads) * 1000:>10.2f}'
+        f'{percentile(reads, 0.99) * 1000:>10.2f}'
+        f'{len(logins) / args.seconds:>10,.1f}'
+        f'{statistics.median(logins) * 1000:>10.2f}{rejected:>6}'
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logins', type=int, default=4, help='greenlets logging in')
+    parser.add_argument('--readers', type=int, default=32, help='greenlets reading')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument(
+        '--latency', type=float, default=0.001, help='seconds added to every query'
+    )
+    parser.add_argument('--offload', choices=MODES)
+    args = parser.parse_args()
+
+    if args.offload is not None:
+        run(args)
+        return 0
+
+    print(
+        f'{"offload":<9}{"reads/s":>9}{"read p50":>10}{"read p99":>10}'
+        f'{"logins/s":>10}{"login p50":>10}{"503s":>6}',
+        flush=True,
+    )
+
+    for mode in MODES:
+        command = [sys.executable, '-m', 'benchmarks.hashing', '--offload', mode]
+        command += ['--logins', str(args.logins), '--readers', str(args.readers)]
+        command += ['--seconds', str(args.seconds), '--latency', str(args.latency)]
+        subprocess.run(command, check=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Rate limiting strategies on a memory storage which sleeps like a network
+# hop.
+#
+#   python -m benchmarks.ratelimits            # storage calls per hit
+#   python -m benchmarks.ratelimits workers    # one key over many workers
+#   python -m benchmarks.ratelimits boundary   # bursts around a window edge
+import sys
+import time
+
+from limits import parse
+from limits.storage import MemoryStorage
+
+from derailedapi.strategies import STRATEGIES
+
+FIXED = 'fixed-window-elastic-expiry'
+LOCAL = 'local-fixed-window-elastic-expiry'
+
+
+class LatentStorage(MemoryStorage):
+    calls = 0
+
+    def __init__(self, latency: float = 0.0005) -> None:
+        super().__init__()
+        self.latency = latency
+
+    def incr(self, *args, **kwargs) -> int:
+        LatentStorage.calls += 1
+        time.sleep(self.latency)
+        return super().incr(*args, **kwargs)
+
+    def get(self, key: str) -> int:
+        LatentStorage.calls += 1
+        time.sleep(self.latency)
+        return super().get(key)
+
+    def get_expiry(self, key: str) -> int:
+        LatentStorage.calls += 1
+        time.sleep(self.latency)
+        return super().get_expiry(key)
+
+
+def bench(hits: int = 10_000, keys: int = 500) -> None:
+    item = parse('50/second')
+
+    for name in (FIXED, LOCAL):
+        storage = LatentStorage()
+        limiter = STRATEGIES[name](storage)
+        LatentStorage.calls = 0
+        admitted = 0
+        started = time.perf_counter()
+
+        for i in range(hits):
+            # what the Limiter does per request with headers enabled
+            ident = str(i % keys)
+            admitted += limiter.hit(item, ident)
+            limiter.get_window_stats(item, ident)
+
+        elapsed = time.perf_counter() - started
+        print(
+            f'{name}: {hits / elapsed:,.0f} hits/s, '
+            f'{LatentStorage.calls / hits:.2f} storage calls/hit, '
+            f'{admitted} admitted'
+        )
+
+
+def workers(limit: str = '50/second', counts: tuple[int, ...] = (1, 9, 33)) -> None:
+    """One client's requests spread round robin over every worker of a box."""
+    item = parse(limit)
+
+    for count in counts:
+        for name in (FIXED, LOCAL):
+            storage = LatentStorage(latency=0)
+            limiters = [STRATEGIES[name](storage) for _ in range(count)]
+            LatentStorage.calls = 0
+            decisions = [
+                limiters[i % count].hit(item, 'client') for i in range(item.amount * 2)
+            ]
+            first_rejected = decisions.index(False) + 1 if False in decisions else None
+            print(
+                f'{count:>3} workers {name}: {sum(decisions)} of {item.amount} '
+                f'admitted, first 429 on request {first_rejected}, '
+                f'{LatentStorage.calls} storage calls'
+            )
+
+
+def boundary(limit: str = '10/second') -> None:
+    """Burst on both sides of a window boundary, fixed windows admit twice."""
+    item = parse(limit)
+
+    for name in ('fixed-window', LOCAL, 'gcra'):
+        storage = MemoryStorage()
+        limiter = STRATEGIES[name](storage)
+        # open a window, then burst at its end and again just past it
+        limiter.hit(item, 'boundary')
+        time.sleep(0.9)
+        admitted = sum(limiter.hit(item, 'boundary') for _ in range(item.amount))
+        time.sleep(0.15)
+        admitted += sum(limiter.hit(item, 'boundary') for _ in range(item.amount))
+        print(f'{name}: {admitted} admitted within 0.15s')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['boundary']:
+        boundary()
+    elif sys.argv[1:] == ['workers']:
+        workers()
+    else:
+        bench()
@@ -0,0 +1,110 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# GET /users/@me/relationships latency against how many relationships the
+# caller has, hydrating the users with batched IN queries (what the route
+# does) and with one lookup per relationship (what it used to do).
+#
+#   python -m benchmarks.relationships --counts 10,100,1000,4000
+import argparse
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault('HASH_OFFLOAD', 'false')
+os.environ.setdefault('AUTH_KEY', 'benchmark')
+
+from . import fakescylla  # noqa: E402
+
+
+def per_row(user_ids: list[int]) -> dict:
+    from derailedapi.statements import fetch_public_user
+
+    users = (fetch_public_user(user_id) for user_id in user_ids)
+    return {user.id: user for user in users if user is not None}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--counts', default='10,100,1000,4000')
+    parser.add_argument('--requests', type=int, default=5, help='per count and mode')
+    parser.add_argument(
+        '--latency', type=float, default=0.001, help='seconds added to every query'
+    )
+    args = parser.parse_args()
+
+    from cassandra.cqlengine import models
+
+    models.DEFAULT_KEYSPACE = 'derailed'
+    session = fakescylla.install(latency=args.latency)
+
+    from app import app
+    from derailedapi.database import Relationship, User
+    from derailedapi.enforgement import forger
+    from derailedapi.ratelimiter import limiter
+    from derailedapi.relationships import routes
+
+    from .routes import Runner
+
+    limiter.enabled = False
+    runner = Runner(app, session, seed=0)
+    runner.register(0)
+    me = runner.accounts[0]
+    client = app.test_client()
+    batched = routes.get_users
+    modes = {'batched': batched, 'per row': per_row}
+    owned = 0
+
+    print(
+        f'{"relationships":>13}{"mode":>10}{"p50 ms":>10}{"max ms":>10}{"queries":>9}'
+    )
+
+    for count in map(int, args.counts.split(',')):
+        for index in range(owned, count):
+            target = User.create(
+                id=forger.forge(),
+                username=f'friend{index}',
+                discriminator=f'{index % 9999 + 1:04}',
+            )
+            Relationship.create(user_id=me.id, target_id=target.id, type=0)
+
+        owned = max(owned, count)
+
+        for name, get_users in modes.items():
+            routes.get_users = get_users
+            took: list[float] = []
+
+            for _ in range(args.requests):
+                queries = session.queries
+                started = time.perf_counter()
+                response = client.get(
+                    '/users/@me/relationships', headers={'Authorization': me.token}
+                )
+                took.append(time.perf_counter() - started)
+                queries = session.queries - queries
+                assert len(response.json) == owned, response.status_code
+
+            print(
+                f'{owned:>13}{name:>10}{statistics.median(took) * 1000:>10.1f}'
+                f'{max(took) * 1000:>10.1f}{queries:>9}'
+            )
+
+    routes.get_users = batched
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Allocations building a relationship list response, through flask's
+# jsonify (orjson's bytes decoded to str, then encoded back by the
+# response) and through `json_response` (orjson's bytes as the body).
+#
+#   python -m benchmarks.responses --sizes 100,1000,4000
+#
+# Peak is the most memory tracemalloc saw held at once while building the
+# response and reading its body, copies is that in body lengths.
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable
+
+os.environ.setdefault('AUTH_KEY', 'benchmark')
+
+
+def relationships(amount: int) -> list[dict[str, Any]]:
+    from derailedapi.relationships.schemas import Relationship
+    from derailedapi.serializers import compile_schema
+
+    dump = compile_schema(Relationship)
+
+    return [
+        dump(
+            {
+                'type': index % 2,
+                'user': {
+                    'id': 634334476998057984 + index,
+                    'username': f'user{index}',
+                    'discriminator': f'{index % 9999 + 1:04}',
+                    'avatar': None,
+                    'banner': None,
+                    'flags': 0,
+                    'bot': False,
+                },
+            }
+        )
+        for index in range(amount)
+    ]
+
+
+def measure(build: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    build().get_data()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def timeit(build: Callable[[], Any], iterations: int) -> float:
+    started = time.perf_counter()
+
+    for _ in range(iterations):
+        build().get_data()
+
+    return (time.perf_counter() - started) / iterations
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='100,1000,4000')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    from flask import jsonify
+
+    from app import app
+    from derailedapi.json import json_response
+
+    print(
+        f'{"rows":>6}{"path":>14}{"body KiB":>10}{"peak KiB":>10}'
+        f'{"copies":>8}{"us/resp":>10}'
+    )
+
+    with app.app_context():
+        for size in map(int, args.sizes.split(',')):
+            body = relationships(size)
+            paths = {
+                'jsonify': lambda: jsonify(body),
+                'json_response': lambda: json_response(body),
+            }
+
+            for name, build in paths.items():
+                length = len(build().get_data())
+                peak = measure(build)
+                took = timeit(build, args.iterations)
+                print(
+                    f'{size:>6}{name:>14}{length / 1024:>10.0f}{peak / 1024:>10.0f}'
+                    f'{peak / length:>8.1f}{took * 1e6:>10.0f}'
+                )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Drives the app through the test client on top of `fakescylla`.
+#
+#   python -m benchmarks.routes --users 50 --requests 2000 --latency 0.001
+#
+# Reports throughput, p50/p99 and queries per request for every route and
+# exits non-zero when a route sends more queries than QUERY_BUDGETS allows,
+# so a regression in query count fails before it reaches production.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any
+
+# requests run one at a time, a hashing pool would only add overhead
+os.environ.setdefault('HASH_OFFLOAD', 'false')
+os.environ.setdefault('AUTH_KEY', 'benchmark')
+
+from . import fakescylla  # noqa: E402
+
+# most queries a route may send per request, the highest seen in the mix.
+# Lower these when a change saves queries, never raise them silently.
+QUERY_BUDGETS = {
+    'register': 9,
+    'login': 1,
+    'get_me': 2,
+    'edit_me': 9,
+    'create_relationship': 11,
+    'modify_relationship': 5,
+    'get_relationships': 3,
+    # bulk_relationships writes once per target, it has no fixed budget
+}
+
+# relative weights of each action once users exist
+MIX = {
+    'get_me': 35,
+    'get_relationships': 25,
+    'create_relationship': 15,
+    'modify_relationship': 10,
+    'bulk_relationships': 5,
+    'edit_me': 10,
+    'login': 5,
+}
+
+
+@dataclass
+class Account:
+    email: str
+    password: str
+    address: str
+    token: str = ''
+    id: int = 0
+    username: str = ''
+    discriminator: str = ''
+    incoming: list[int] = field(default_factory=list)
+
+
+@dataclass
+class Sample:
+    seconds: float
+    queries: int
+    status: int
+
+
+class Runner:
+    def __init__(self, app: Any, session: fakescylla.Session, seed: int) -> None:
+        self.client = app.test_client()
+        self.session = session
+        self.random = random.Random(seed)
+        self.accounts: list[Account] = []
+        self.samples: dict[str, list[Sample]] = defaultdict(list)
+
+    def call(self, route: str, account: Account, method: str, path: str, **kwargs):
+        headers = {'Authorization': account.token} if account.token else {}
+        before = self.session.queries
+        started = time.perf_counter()
+        response = getattr(self.client, method)(
+            path,
+            headers=headers,
+            environ_base={'REMOTE_ADDR': account.address},
+            **kwargs,
+        )
+        elapsed = time.perf_counter() - started
+        self.samples[route].append(
+            Sample(elapsed, self.session.queries - before, response.status_code)
+        )
+        return response
+
+    def register(self, index: int) -> None:
+        account = Account(
+            email=f'user{index}@bench.derailed',
+            password=f'password{index}',
+            address=f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}',
+        )
+        response = self.call(
+            'register',
+            account,
+            'post',
+            '/register',
+            json={
+                # a handful of names, so discriminators are actually shared
+                'username': f'user{index % 7}',
+                'email': account.email,
+                'password': account.password,
+            },
+        )
+        account.token = response.json['token']
+        self.accounts.append(account)
+        self.get_me(account)
+
+    def login(self, account: Account) -> None:
+        response = self.call(
+            'login',
+            account,
+            'post',
+            '/login',
+            json={'email': account.email, 'password': account.password},
+        )
+        account.token = response.json['token']
+
+    def get_me(self, account: Account) -> None:
+        me = self.call('get_me', account, 'get', '/users/@me').json
+        account.id = int(me['id'])
+        account.username = me['username']
+        account.discriminator = me['discriminator']
+
+    def edit_me(self, account: Account) -> None:
+        response = self.call(
+            'edit_me',
+            account,
+            'patch',
+            '/users/@me',
+            json={'username': f'renamed{self.random.randrange(7)}'},
+        )
+
+        if response.status_code == 200:
+            account.username = response.json['username']
+            account.discriminator = response.json['discriminator']
+
+    def create_relationship(self, account: Account) -> None:
+        target = self.random.choice(self.accounts)
+        response = self.call(
+            'create_relationship',
+            account,
+            'post',
+            '/users/@me/relationships',
+            json={
+                'type': 0,
+                'username': target.username,
+                'discriminator': target.discriminator,
+            },
+        )
+
+        if response.status_code == 204:
+            target.incoming.append(account.id)
+
+    def modify_relationship(self, account: Account) -> None:
+        if not account.incoming:
+            return self.create_relationship(account)
+
+        self.call(
+            'modify_relationship',
+            account,
+            'patch',
+            '/users/@me/relationships',
+            json={'user_id': account.incoming.pop(), 'accept': True},
+        )
+
+    def bulk_relationships(self, account: Account) -> None:
+        if not account.incoming:
+            return self.create_relationship(account)
+
+        operations = [
+            {'user_id': user_id, 'action': 'accept'} for user_id in account.incoming
+        ]
+        account.incoming.clear()
+        self.call(
+            'bulk_relationships',
+            account,
+            'post',
+            '/users/@me/relationships/bulk',
+            json={'operations': operations},
+        )
+
+    def get_relationships(self, account: Account) -> None:
+        self.call('get_relationships', account, 'get', '/users/@me/relationships')
+
+    def run(self, users: int, requests: int) -> float:
+        for index in range(users):
+            self.register(index)
+
+        for account in self.accounts:
+            self.login(account)
+
+        actions = list(MIX)
+        weights = list(MIX.values())
+        started = time.perf_counter()
+
+        for _ in range(requests):
+            action = self.random.choices(actions, weights)[0]
+            getattr(self, action)(self.random.choice(self.accounts))
+
+        return time.perf_counter() - started
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(runner: Runner, elapsed: float, requests: int) -> list[str]:
+    over_budget = []
+    print(
+        f'{"route":<22}{"count":>7}{"req/s":>9}{"p50 ms":>9}{"p99 ms":>9}'
+        f'{"queries":>9}{"max":>5}{"errors":>8}'
+    )
+
+    for route, samples in sorted(runner.samples.items()):
+        seconds = [s.seconds for s in samples]
+        queries = [s.queries for s in samples]
+        errors = sum(s.status >= 500 for s in samples)
+        print(
+            f'{route:<22}{len(samples):>7}{len(samples) / sum(seconds):>9,.0f}'
+            f'{percentile(seconds, 0.5) * 1000:>9.2f}'
+            f'{percentile(seconds, 0.99) * 1000:>9.2f}'
+            f'{statistics.mean(queries):>9.2f}{max(queries):>5}{errors:>8}'
+        )
+
+        if max(queries) > QUERY_BUDGETS.get(route, max(queries)):
+            over_budget.append(route)
+
+    print(f'\nmixed workload: {requests / elapsed:,.0f} req/s')
+    return over_budget
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument(
+        '--latency', type=float, default=0.001, help='seconds added to every query'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from cassandra.cqlengine import models
+
+    models.DEFAULT_KEYSPACE = 'derailed'
+    session = fakescylla.install(latency=args.latency)
+
+    from app import app
+
+    runner = Runner(app, session, seed=args.seed)
+    elapsed = runner.run(users=args.users, requests=args.requests)
+    over_budget = report(runner, elapsed, args.requests)
+
+    for route in over_budget:
+        print(f'{route} sent more than {QUERY_BUDGETS[route]} queries', file=sys.stderr)
+
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
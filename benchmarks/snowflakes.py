@@ -0,0 +1,102 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Forging throughput from threads and `forge_many`, and duplicates across
+# processes which get their process id the way gunicorn workers do.
+#
+#   python -m benchmarks.snowflakes --threads 4 --processes 17
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from derailedapi.enforgement import SnowflakeFactory, forger, process_slot
+
+
+def forge_in_process(process_id: int, count: int, queue) -> None:
+    # the way gunicorn workers get theirs, through the environment
+    os.environ['SNOWFLAKE_PROCESS_ID'] = str(process_id)
+    forger.refresh_process_id()
+    queue.put(forger.forge_many(count))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=17)
+    parser.add_argument('--count', type=int, default=100_000, help='ids per forger')
+    args = parser.parse_args()
+
+    factory = SnowflakeFactory(worker_id=1, process_id=0)
+    results: list[list[int]] = [[] for _ in range(args.threads)]
+
+    def forge_all(index: int) -> None:
+        results[index] = [factory.forge() for _ in range(args.count)]
+
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=forge_all, args=(i,)) for i in range(args.threads)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - started
+    forged = [i for r in results for i in r]
+    print(
+        f'{args.threads} threads: {len(forged) / elapsed:,.0f} ids/s, '
+        f'{len(forged) - len(set(forged))} duplicates'
+    )
+
+    started = time.perf_counter()
+    bulk = factory.forge_many(args.count)
+    elapsed = time.perf_counter() - started
+    print(f'forge_many: {args.count / elapsed:,.0f} ids/s')
+
+    queue = multiprocessing.Queue()
+    slots: set[int] = set()
+    processes = []
+
+    for _ in range(args.processes):
+        slot = process_slot(slots)
+        slots.add(slot)
+        processes.append(
+            multiprocessing.Process(
+                target=forge_in_process, args=(slot, args.count, queue)
+            )
+        )
+
+    for process in processes:
+        process.start()
+
+    everything = forged + bulk + [i for _ in processes for i in queue.get()]
+
+    for process in processes:
+        process.join()
+
+    print(
+        f'{args.threads} threads + {args.processes} processes: '
+        f'{len(everything):,} ids, {len(everything) - len(set(everything))} duplicates'
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
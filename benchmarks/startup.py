@@ -0,0 +1,128 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Time for a box's workers to become ready, against a real cluster.
+#
+#   python -m benchmarks.startup --workers 17
+#
+# `eager` is the old boot, every worker connected and synced every table
+# on import. `lazy` is the current one, `derailedapi.migrations` runs once
+# and every worker only connects after the fork. The cluster comes from
+# the same SCYLLA_* variables the app uses, `fakescylla` has no schema so
+# it cannot stand in here.
+import argparse
+import multiprocessing
+import statistics
+import sys
+import time
+from typing import Any
+
+STRATEGIES = ('eager', 'lazy')
+
+
+def _count_ddl(session: Any, counts: dict[str, int]) -> None:
+    def listener(future: Any) -> None:
+        query = getattr(future, 'query', None)
+        text = getattr(query, 'query_string', None) or str(query)
+        counts['queries'] += 1
+
+        if text.lstrip().upper().startswith(('CREATE', 'ALTER')):
+            counts['ddl'] += 1
+
+    session.add_request_init_listener(listener)
+
+
+def worker(strategy: str, results: Any) -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    from cassandra.cqlengine import connection
+
+    from derailedapi.database import ensure_connected, sync_tables
+
+    started = time.perf_counter()
+    counts = {'queries': 0, 'ddl': 0}
+    ensure_connected()
+    _count_ddl(connection.get_session(), counts)
+
+    if strategy == 'eager':
+        sync_tables()
+
+    results.put((time.perf_counter() - started, counts['queries'], counts['ddl']))
+
+
+def migrate() -> float:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    from derailedapi.database import connect
+    from derailedapi.migrations import migrate
+
+    started = time.perf_counter()
+    connect()
+    migrate()
+    return time.perf_counter() - started
+
+
+def run(strategy: str, workers: int) -> None:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    started = time.perf_counter()
+    # the deploy step, run once before gunicorn starts
+    once = migrate() if strategy == 'lazy' else 0.0
+    processes = [
+        context.Process(target=worker, args=(strategy, results)) for _ in range(workers)
+    ]
+
+    for process in processes:
+        process.start()
+
+    samples = [results.get() for _ in processes]
+
+    for process in processes:
+        process.join()
+
+    elapsed = time.perf_counter() - started
+    seconds = [s for s, _, _ in samples]
+    print(
+        f'{strategy:<8}{elapsed:>9.2f}{once:>9.2f}'
+        f'{statistics.median(seconds):>9.2f}{max(seconds):>9.2f}'
+        f'{sum(q for _, q, _ in samples):>9}{sum(d for _, _, d in samples):>6}'
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--workers', type=int, default=multiprocessing.cpu_count() * 2 + 1
+    )
+    parser.add_argument('--strategy', choices=STRATEGIES, action='append')
+    args = parser.parse_args()
+
+    print(
+        f'{"boot":<8}{"total s":>9}{"once s":>9}{"p50 s":>9}{"max s":>9}'
+        f'{"queries":>9}{"ddl":>6}'
+    )
+
+    for strategy in args.strategy or STRATEGIES:
+        run(strategy, args.workers)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# The hot queries through cqlengine and through `derailedapi.statements`.
+#
+#   python -m benchmarks.statements --iterations 5000
+#   python -m benchmarks.statements --cluster  # SCYLLA_* from the env
+#
+# On `fakescylla` this is the client side only, building the query and
+# the result. Against a cluster it includes the server parsing every
+# unprepared statement and the token-aware routing prepared ones get.
+import argparse
+import os
+import sys
+import time
+from typing import Any, Callable
+
+os.environ.setdefault('AUTH_KEY', 'benchmark')
+
+
+def cases(user_id: int, target_id: int) -> list[tuple[str, Callable, Callable]]:
+    from derailedapi import statements
+    from derailedapi.database import Relationship, Settings, User
+
+    return [
+        (
+            'auth user by id',
+            lambda: User.objects(User.id == user_id)
+            .only(['id', 'password', 'token_generation'])
+            .get(),
+            lambda: statements.fetch_auth_user(user_id),
+        ),
+        (
+            'public user by id',
+            lambda: User.objects(User.id == user_id)
+            .only(list(statements.PublicUser._fields))
+            .get(),
+            lambda: statements.fetch_public_user(user_id),
+        ),
+        (
+            'settings by user',
+            lambda: Settings.objects(Settings.user_id == user_id).get(),
+            lambda: statements.fetch_settings(user_id),
+        ),
+        (
+            'relationship by pair',
+            lambda: Relationship.objects(
+                Relationship.user_id == user_id, Relationship.target_id == target_id
+            ).get(),
+            lambda: statements.fetch_relationship(user_id, target_id),
+        ),
+        (
+            'insert relationship',
+            lambda: Relationship.create(user_id=user_id, target_id=target_id, type=0),
+            lambda: statements.insert_relationship(user_id, target_id, 0),
+        ),
+    ]
+
+
+def timeit(func: Callable[[], Any], iterations: int) -> float:
+    func()
+    started = time.perf_counter()
+
+    for _ in range(iterations):
+        func()
+
+    return (time.perf_counter() - started) / iterations
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument(
+        '--cluster', action='store_true', help='use the cluster from SCYLLA_*'
+    )
+    args = parser.parse_args()
+
+    if args.cluster:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+
+        from derailedapi.database import connect
+
+        connect()
+    else:
+        from cassandra.cqlengine import models
+
+        from . import fakescylla
+
+        models.DEFAULT_KEYSPACE = 'derailed'
+        fakescylla.install()
+
+    from derailedapi.database import Relationship, Settings, User
+    from derailedapi.enforgement import forger
+
+    user_id, target_id = forger.forge(), forger.forge()
+    User.create(id=user_id, username='bench', discriminator='0001', password='x')
+    Settings.create(user_id=user_id)
+    Relationship.create(user_id=user_id, target_id=target_id, type=0)
+
+    print(f'{"query":<24}{"cqlengine us":>14}{"prepared us":>13}{"speedup":>9}')
+
+    for name, cqlengine, prepared in cases(user_id, target_id):
+        slow = timeit(cqlengine, args.iterations)
+        fast = timeit(prepared, args.iterations)
+        print(f'{name:<24}{slow * 1e6:>14.1f}{fast * 1e6:>13.1f}{slow / fast:>8.1f}x')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from apiflask import APIBlueprint, HTTPError
+from cassandra.cqlengine.query import BatchQuery, LWTException
+
+from ..database import Channel, ChannelByUser, DMChannelByPair, Message, Recipient
+from ..enforgement import forger
+from ..enums import ChannelType
+from ..serializers import fast_output
+from ..statements import fetch_public_user
+from ..users.routes import authorize
+from ..users.schemas import Authorization, AuthorizationObject
+from .schemas import (
+    ChannelListing,
+    ChannelListingData,
+    CreateMessage,
+    CreateMessageData,
+    DMChannel,
+)
+from .schemas import Message as MessageData
+from .schemas import MessageHistory, MessageHistoryData, OpenDM, OpenDMData, UserChannel
+
+channels = APIBlueprint('channels', __name__)
+
+
+def ensure_recipient(channel_id: int, user_id: int) -> None:
+    try:
+        Recipient.objects(
+            Recipient.channel_id == channel_id, Recipient.user_id == user_id
+        ).get()
+    except Recipient.DoesNotExist:
+        raise HTTPError(404, 'Channel does not exist')
+
+
+def touch_channel(channel_id: int, recipients: list[int], message_id: int) -> None:
+    """Move ``channel_id`` to the top of every recipient's channel list."""
+    channel: Channel = (
+        Channel.objects(Channel.id == channel_id)
+        .only(['type', 'last_message_id'])
+        .get()
+    )
+    previous = channel.last_message_id or channel_id
+
+    # two messages racing can both move away from the same `previous`,
+    # leaving an outdated row behind, listings skip those.
+    with BatchQuery() as batch:
+        for user_id in recipients:
+            ChannelByUser.objects(
+                ChannelByUser.user_id == user_id,
+                ChannelByUser.last_activity == previous,
+                ChannelByUser.channel_id == channel_id,
+            ).batch(batch).delete()
+            ChannelByUser.batch(batch).create(
+                user_id=user_id,
+                last_activity=message_id,
+                channel_id=channel_id,
+                type=channel.type,
+            )
+
+        Channel.objects(Channel.id == channel_id).batch(batch).update(
+            last_message_id=message_id
+        )
+
+
+def last_message_id(channel_id: int) -> int | None:
+    try:
+        channel: Channel = (
+            Channel.objects(Channel.id == channel_id).only(['last_message_id']).get()
+        )
+    except Channel.DoesNotExist:
+        raise HTTPError(404, 'Channel does not exist')
+
+    return channel.last_message_id
+
+
+def newest_first(
+    channel_id: int, before: int | None, after: int | None, limit: int, last: int
+) -> list[Message]:
+    # a channel cannot hold messages older than itself, or newer than its
+    # last one, whatever `before` says
+    top = last if before is None else min(before - 1, last)
+    buckets = forger.make_buckets(max(after or 0, channel_id), top)
+    messages: list[Message] = []
+
+    for bucket in reversed(buckets):
+        query = Message.objects(
+            Message.channel_id == channel_id, Message.bucket == bucket
+        )
+
+        if before is not None:
+            query = query.filter(Message.id < before)
+
+        if after is not None:
+            query = query.filter(Message.id > after)
+
+        messages.extend(query.limit(limit - len(messages)))
+
+        if len(messages) == limit:
+            break
+
+    return messages
+
+
+def oldest_first(channel_id: int, after: int, limit: int, last: int) -> list[Message]:
+    messages: list[Message] = []
+
+    for bucket in forger.make_buckets(max(after, channel_id), last):
+        query = (
+            Message.objects(
+                Message.channel_id == channel_id,
+                Message.bucket == bucket,
+                Message.id > after,
+            )
+            .order_by('id')
+            .limit(limit - len(messages))
+        )
+        messages.extend(query)
+
+        if len(messages) == limit:
+            break
+
+    return messages
+
+
+@channels.post('/channels/<int:channel_id>/messages')
+@channels.input(CreateMessage)
+@channels.input(Authorization, 'headers')
+@channels.output(MessageData, 201)
+@channels.doc(tag='Channels')
+@fast_output(MessageData)
+def create_message(
+    channel_id: int, json: CreateMessageData, headers: AuthorizationObject
+):
+    me = authorize(headers['authorization'])
+    recipients = [
+        r.user_id for r in Recipient.objects(Recipient.channel_id == channel_id)
+    ]
+
+    if me.id not in recipients:
+        raise HTTPError(404, 'Channel does not exist')
+
+    message_id = forger.forge()
+    message = Message.create(
+        channel_id=channel_id,
+        bucket=forger.make_bucket(message_id),
+        id=message_id,
+        author_id=me.id,
+        content=json['content'],
+    )
+    touch_channel(channel_id=channel_id, recipients=recipients, message_id=message_id)
+
+    return message
+
+
+@channels.get('/channels/<int:channel_id>/messages')
+@channels.input(MessageHistory, 'query')
+@channels.input(Authorization, 'headers')
+@channels.output(MessageData(many=True), description='Messages, newest first')
+@channels.doc(tag='Channels')
+@fast_output(MessageData, many=True)
+def get_messages(
+    channel_id: int, query: MessageHistoryData, headers: AuthorizationObject
+):
+    me = authorize(headers['authorization'])
+    ensure_recipient(channel_id=channel_id, user_id=me.id)
+
+    before = query.get('before')
+    after = query.get('after')
+    last = last_message_id(channel_id)
+
+    if last is None:
+        return []
+
+    if after is not None and before is None:
+        # the page closest to `after`, not the newest messages
+        messages = oldest_first(
+            channel_id=channel_id, after=after, limit=query['limit'], last=last
+        )
+        messages.reverse()
+        return messages
+
+    return newest_first(
+        channel_id=channel_id,
+        before=before,
+        after=after,
+        limit=query['limit'],
+        last=last,
+    )
+
+
+def discard_channel(channel_id: int, recipients: list[int]) -> None:
+    """Delete a channel which never got a message."""
+    with BatchQuery() as batch:
+        for user_id in recipients:
+            ChannelByUser.objects(
+                ChannelByUser.user_id == user_id,
+                ChannelByUser.last_activity == channel_id,
+                ChannelByUser.channel_id == channel_id,
+            ).batch(batch).delete()
+            Recipient.objects(
+                Recipient.channel_id == channel_id, Recipient.user_id == user_id
+            ).batch(batch).delete()
+
+        Channel.objects(Channel.id == channel_id).batch(batch).delete()
+
+
+@channels.post('/users/@me/channels')
+@channels.input(OpenDM)
+@channels.input(Authorization, 'headers')
+@channels.output(DMChannel)
+@channels.doc(tag='Channels')
+@fast_output(DMChannel)
+def open_dm(json: OpenDMData, headers: AuthorizationObject):
+    me = authorize(headers['authorization'])
+    recipient_id = json['recipient_id']
+
+    if recipient_id == me.id:
+        raise HTTPError(400, 'You cannot message yourself')
+
+    lower, higher = sorted((me.id, recipient_id))
+
+    try:
+        pair: DMChannelByPair = DMChannelByPair.objects(
+            DMChannelByPair.user_id == lower, DMChannelByPair.other_id == higher
+        ).get()
+    except DMChannelByPair.DoesNotExist:
+        pass
+    else:
+        return {
+            'id': pair.channel_id,
+            'type': ChannelType.DIRECT_MESSAGE,
+            'recipient_id': recipient_id,
+        }
+
+    if fetch_public_user(recipient_id) is None:
+        raise HTTPError(404, 'Recipient does not exist')
+
+    channel_id = forger.forge()
+
+    # the pair goes last, so it never points at a channel without rows
+    with BatchQuery() as batch:
+        Channel.batch(batch).create(id=channel_id, type=ChannelType.DIRECT_MESSAGE)
+
+        for user_id in (lower, higher):
+            Recipient.batch(batch).create(channel_id=channel_id, user_id=user_id)
+            ChannelByUser.batch(batch).create(
+                user_id=user_id,
+                last_activity=channel_id,
+                channel_id=channel_id,
+                type=ChannelType.DIRECT_MESSAGE,
+            )
+
+    try:
+        DMChannelByPair.if_not_exists().create(
+            user_id=lower, other_id=higher, channel_id=channel_id
+        )
+    except LWTException:
+        # opened by the other user at the same time, theirs is kept
+        pair = DMChannelByPair.objects(
+            DMChannelByPair.user_id == lower, DMChannelByPair.other_id == higher
+        ).get()
+        discard_channel(channel_id, recipients=[lower, higher])
+        channel_id = pair.channel_id
+
+    return {
+        'id': channel_id,
+        'type': ChannelType.DIRECT_MESSAGE,
+        'recipient_id': recipient_id,
+    }
+
+
+@channels.get('/users/@me/channels')
+@channels.input(ChannelListing, 'query')
+@channels.input(Authorization, 'headers')
+@channels.output(UserChannel(many=True), description='Your channels, most active first')
+@channels.doc(tag='Channels')
+@fast_output(UserChannel, many=True)
+def get_channels(query: ChannelListingData, headers: AuthorizationObject):
+    me = authorize(headers['authorization'])
+    rows = ChannelByUser.objects(ChannelByUser.user_id == me.id).limit(query['limit'])
+
+    listed: dict[int, dict] = {}
+
+    for row in rows:
+        # rows are newest first, so an outdated duplicate always comes later
+        if row.channel_id not in listed:
+            listed[row.channel_id] = {
+                'id': row.channel_id,
+                'type': row.type,
+                'last_activity': row.last_activity,
+            }
+
+    return list(listed.values())
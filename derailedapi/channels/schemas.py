@@ -13,3 +13,75 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, TypedDict
+
+from apiflask import Schema
+from apiflask.fields import Integer, String
+from apiflask.validators import Length, Range
+
+from ..fields import Snowflake
+
+if TYPE_CHECKING:
+    from typing_extensions import NotRequired
+
+
+class CreateMessage(Schema):
+    content: str = String(required=True, validate=Length(1, 2000))
+
+
+class CreateMessageData(TypedDict):
+    content: str
+
+
+# the most a snowflake can be, it is stored as a signed 64-bit integer
+MAX_SNOWFLAKE = 2**63 - 1
+
+
+class MessageHistory(Schema):
+    before: int = Integer(validate=Range(0, MAX_SNOWFLAKE))
+    after: int = Integer(validate=Range(0, MAX_SNOWFLAKE))
+    limit: int = Integer(load_default=50, validate=Range(1, 100))
+
+
+class MessageHistoryData(TypedDict):
+    before: NotRequired[int]
+    after: NotRequired[int]
+    limit: int
+
+
+class Message(Schema):
+    id: int = Snowflake()
+    channel_id: int = Snowflake()
+    author_id: int = Snowflake()
+    content: str = String()
+
+
+class OpenDM(Schema):
+    recipient_id: int = Integer(required=True)
+
+
+class OpenDMData(TypedDict):
+    recipient_id: int
+
+
+class DMChannel(Schema):
+    id: int = Snowflake()
+    type: int = Integer()
+    recipient_id: int = Snowflake()
+
+
+class ChannelListing(Schema):
+    limit: int = Integer(load_default=100, validate=Range(1, 200))
+
+
+class ChannelListingData(TypedDict):
+    limit: int
+
+
+class UserChannel(Schema):
+    id: int = Snowflake()
+    type: int = Integer()
+    # the newest message's id, the channel's own before the first one
+    last_activity: int = Snowflake()
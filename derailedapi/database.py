@@ -15,42 +15,223 @@ limitations under the License.
 """
 import base64
 import binascii
+import logging
 import os
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Type
 
 import itsdangerous
 from apiflask import HTTPError
+from cassandra import UnsupportedOperation
 from cassandra.auth import PlainTextAuthProvider
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, ExecutionProfile
+from cassandra.connection import Connection
 from cassandra.cqlengine import columns, connection, management, models
-from cassandra.io import asyncorereactor, geventreactor
+from cassandra.policies import DCAwareRoundRobinPolicy, HostDistance, TokenAwarePolicy
+from flask import g, has_request_context
 
+from derailedapi import metrics
+from derailedapi.cache import TTLCache
 from derailedapi.enforgement import forger
+from derailedapi.instrumentation import instrument_session
+
+if TYPE_CHECKING:
+    from derailedapi.statements import AuthUser
 
 auth_provider = PlainTextAuthProvider(
     os.getenv('SCYLLA_USER'), os.getenv('SCYLLA_PASSWORD')
 )
 
 
+log = logging.getLogger(__name__)
+
+
 def get_hosts():
     hs = os.getenv('SCYLLA_HOSTS')
 
     return None if hs is None else hs.split(',')
 
 
-def connect():
-    connection_class = (
-        geventreactor.GeventConnection
-        if os.getenv('GEVENT') == 'true'
-        else asyncorereactor.AsyncoreConnection
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return default if not value else value.lower() == 'true'
+
+
+def _env_int(name: str) -> int | None:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+@dataclass
+class ScyllaConfig:
+    hosts: list[str] | None = None
+    keyspace: str = 'derailed'
+    # the datacenter this deployment lives in, requests stay inside it
+    local_dc: str | None = None
+    token_aware: bool = True
+    # lz4, snappy, none, or auto to use whatever is installed
+    compression: str = 'auto'
+    protocol_version: int | None = None
+    connect_timeout: float = 100
+    request_timeout: float = 10
+    # only honoured by protocol versions 1 and 2, newer ones always
+    # multiplex a single connection per host (or per shard on scylla)
+    connections_per_host: int | None = None
+    # concurrent requests allowed on a single connection
+    max_in_flight: int | None = None
+    executor_threads: int = 2
+    # gevent, libev, asyncore, or auto to match the running worker
+    reactor: str = 'auto'
+
+    @classmethod
+    def from_env(cls) -> 'ScyllaConfig':
+        return cls(
+            hosts=get_hosts(),
+            keyspace=os.getenv('SCYLLA_KEYSPACE') or 'derailed',
+            local_dc=os.getenv('SCYLLA_LOCAL_DC') or None,
+            token_aware=_env_bool('SCYLLA_TOKEN_AWARE', True),
+            compression=os.getenv('SCYLLA_COMPRESSION') or 'auto',
+            protocol_version=_env_int('SCYLLA_PROTOCOL_VERSION'),
+            connect_timeout=float(os.getenv('SCYLLA_CONNECT_TIMEOUT') or 100),
+            request_timeout=float(os.getenv('SCYLLA_REQUEST_TIMEOUT') or 10),
+            connections_per_host=_env_int('SCYLLA_CONNECTIONS_PER_HOST'),
+            max_in_flight=_env_int('SCYLLA_MAX_IN_FLIGHT'),
+            executor_threads=_env_int('SCYLLA_EXECUTOR_THREADS') or 2,
+            reactor=os.getenv('SCYLLA_REACTOR') or 'auto',
+        )
+
+
+def _gevent_running() -> bool:
+    if os.getenv('GEVENT') == 'true':
+        return True
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    return monkey.is_module_patched('socket')
+
+
+def _resolve_reactor(name: str) -> Type[Connection]:
+    if name == 'auto':
+        name = 'gevent' if _gevent_running() else 'libev'
+
+    if name == 'gevent':
+        from cassandra.io.geventreactor import GeventConnection
+
+        return GeventConnection
+
+    if name == 'libev':
+        try:
+            from cassandra.io.libevreactor import LibevConnection
+        except ImportError:
+            log.warning('libev is not available, falling back to asyncore')
+        else:
+            return LibevConnection
+
+    from cassandra.io.asyncorereactor import AsyncoreConnection
+
+    return AsyncoreConnection
+
+
+def _resolve_compression(name: str) -> str | bool:
+    if name == 'auto':
+        return True
+
+    if name == 'none':
+        return False
+
+    return name
+
+
+_connect_lock = threading.Lock()
+_connected_pid: int | None = None
+
+
+def ensure_connected() -> None:
+    """Connect once per process, sessions must not be shared over a fork."""
+    global _connected_pid
+
+    if _connected_pid == os.getpid():
+        return
+
+    with _connect_lock:
+        if _connected_pid != os.getpid():
+            connect()
+            _connected_pid = os.getpid()
+
+
+def connect(config: ScyllaConfig | None = None):
+    config = config or ScyllaConfig.from_env()
+    connection_class = _resolve_reactor(config.reactor)
+
+    if config.max_in_flight is not None:
+        connection_class = type(
+            connection_class.__name__,
+            (connection_class,),
+            {
+                'max_in_flight': config.max_in_flight,
+                'orphaned_threshold': 3 * config.max_in_flight // 4,
+            },
+        )
+
+    load_balancing_policy = DCAwareRoundRobinPolicy(local_dc=config.local_dc)
+
+    if config.token_aware:
+        load_balancing_policy = TokenAwarePolicy(load_balancing_policy)
+
+    profile = ExecutionProfile(
+        load_balancing_policy=load_balancing_policy,
+        request_timeout=config.request_timeout,
+    )
+
+    if metrics.ENABLED:
+        profile.retry_policy = metrics.CountingRetryPolicy()
+
+    extra = {}
+
+    if config.protocol_version is not None:
+        extra['protocol_version'] = config.protocol_version
+
+    log.info(
+        'connecting to scylla with %s (reactor: %s, compression: %s)',
+        config,
+        connection_class.__name__,
+        _resolve_compression(config.compression),
     )
 
     connection.setup(
-        get_hosts(),
-        'derailed',
+        config.hosts,
+        config.keyspace,
         auth_provider=auth_provider,
-        connect_timeout=100,
+        connect_timeout=config.connect_timeout,
         retry_connect=True,
         connection_class=connection_class,
+        compression=_resolve_compression(config.compression),
+        executor_threads=config.executor_threads,
+        execution_profiles={EXEC_PROFILE_DEFAULT: profile},
+        **extra,
     )
+    instrument_session(connection.get_session())
+    metrics.instrument_session(connection.get_session())
+
+    if config.connections_per_host is not None:
+        cluster = connection.get_cluster()
+
+        try:
+            cluster.set_core_connections_per_host(
+                HostDistance.LOCAL, config.connections_per_host
+            )
+            cluster.set_max_connections_per_host(
+                HostDistance.LOCAL, config.connections_per_host
+            )
+        except UnsupportedOperation:
+            log.warning(
+                'SCYLLA_CONNECTIONS_PER_HOST is ignored with protocol version %s',
+                cluster.protocol_version,
+            )
 
 
 class User(models.Model):
@@ -65,6 +246,29 @@ class User(models.Model):
     flags: int = columns.Integer(default=0)
     bot: bool = columns.Boolean(default=False)
     verified: bool | None = columns.Boolean(default=False)
+    # bumped to revoke every server-signed token issued to this user
+    token_generation: int | None = columns.Integer(default=0)
+
+
+# what login needs about a user, so it takes one partition read.
+# kept in sync by register and edit_me.
+class Credential(models.Model):
+    __table_name__ = 'credentials'
+    email: str = columns.Text(primary_key=True)
+    user_id: int = columns.BigInt()
+    password: str = columns.Text()
+    token_generation: int | None = columns.Integer(default=0)
+    mfa_enabled: bool = columns.Boolean(default=False)
+    mfa_code: str = columns.Text()
+
+
+class DiscriminatorAllocation(models.Model):
+    __table_name__ = 'discriminator_allocations'
+    username: str = columns.Text(primary_key=True)
+    # bit n is set when discriminator n is taken for this username
+    slots: bytes = columns.Blob()
+    # compared and bumped on every write, guarding `slots`
+    version: int = columns.Integer()
 
 
 class GuildPosition(models.Model):
@@ -97,15 +301,31 @@ class RecoveryCode(models.Model):
 # Max Outgoing Friend Requests and Incoming is 2000.
 # Max Friends is set to 4000.
 class Relationship(models.Model):
-    __table_name__ = 'relationships'
+    __table_name__ = 'relationships_by_user'
     # the user id who created the relationship
-    user_id: int = columns.BigInt(primary_key=True)
+    user_id: int = columns.BigInt(primary_key=True, partition_key=True)
     # the user id who friended/blocked/etc the relationship
-    target_id: int = columns.BigInt(index=True)
+    target_id: int = columns.BigInt(primary_key=True)
     # the type of relationship
     type: int = columns.Integer()
 
 
+# the layout relationships were stored in before `relationships_by_user`,
+# kept around until `derailedapi.relationships.migrate` has copied it.
+class LegacyRelationship(models.Model):
+    __table_name__ = 'relationships'
+    user_id: int = columns.BigInt(primary_key=True)
+    target_id: int = columns.BigInt(index=True)
+    type: int = columns.Integer()
+
+
+class RelationshipCount(models.Model):
+    __table_name__ = 'relationship_counts'
+    user_id: int = columns.BigInt(primary_key=True)
+    # how many `relationships_by_user` rows this user owns
+    count: int = columns.Counter()
+
+
 class Activity(models.Model):
     __table_name__ = 'activities'
     user_id: int = columns.BigInt(primary_key=True)
@@ -121,12 +341,13 @@ class Channel(models.Model):
     id: int = columns.BigInt(primary_key=True)
     type: int = columns.Integer()
     name: str = columns.Text()
+    last_message_id: int = columns.BigInt()
 
 
 class Recipient(models.Model):
     __table_name__ = 'recipients'
     channel_id: int = columns.BigInt(primary_key=True)
-    user_id: int = columns.BigInt()
+    user_id: int = columns.BigInt(primary_key=True)
 
 
 class GroupDMChannel(models.Model):
@@ -136,46 +357,220 @@ class GroupDMChannel(models.Model):
     owner_id: int = columns.BigInt()
 
 
-def create_token(user_id: int, user_password: str) -> str:
-    signer = itsdangerous.TimestampSigner(user_password)
-    user_id = str(user_id)
-    user_id = base64.b64encode(user_id.encode())
+# the direct message channel between two users,
+# `user_id` is always the lower of the two ids.
+class DMChannelByPair(models.Model):
+    __table_name__ = 'dm_channels_by_pair'
+    user_id: int = columns.BigInt(primary_key=True, partition_key=True)
+    other_id: int = columns.BigInt(primary_key=True, partition_key=True)
+    channel_id: int = columns.BigInt()
 
-    return signer.sign(user_id).decode()
 
+# every channel a user is in, most recently active first.
+# `last_activity` is the channel's last message id, or its own id
+# before any message was sent.
+class ChannelByUser(models.Model):
+    __table_name__ = 'channels_by_user'
+    user_id: int = columns.BigInt(primary_key=True, partition_key=True)
+    last_activity: int = columns.BigInt(primary_key=True, clustering_order='DESC')
+    channel_id: int = columns.BigInt(primary_key=True)
+    type: int = columns.Integer()
 
-def verify_token(token: str | None):
-    if token is None:
-        raise HTTPError(401, 'Authorization is invalid')
 
-    fragmented = token.split('.')
-    user_id = fragmented[0]
+# messages are split into 4-day buckets per channel (see
+# `SnowflakeFactory.make_bucket`), so no partition grows forever.
+class Message(models.Model):
+    __table_name__ = 'messages'
+    channel_id: int = columns.BigInt(primary_key=True, partition_key=True)
+    bucket: int = columns.Integer(primary_key=True, partition_key=True)
+    id: int = columns.BigInt(primary_key=True, clustering_order='DESC')
+    author_id: int = columns.BigInt()
+    content: str = columns.Text()
+
+
+# tokens signed with AUTH_KEY carry the user id and their token generation,
+# so their signature can be checked without reading the user.
+# tokens signed with the user's password hash are still accepted.
+auth_key = os.getenv('AUTH_KEY') or None
+
+
+def _server_signer() -> itsdangerous.TimestampSigner:
+    return itsdangerous.TimestampSigner(auth_key, salt='derailed.token')
+
+
+def create_token(
+    user_id: int, user_password: str, token_generation: int | None = 0
+) -> str:
+    encoded_id = base64.b64encode(str(user_id).encode())
+
+    if auth_key is None:
+        signer = itsdangerous.TimestampSigner(user_password)
+        return signer.sign(encoded_id).decode()
 
+    payload = encoded_id + b'.' + str(token_generation or 0).encode()
+    return _server_signer().sign(payload).decode()
+
+
+def _decode_user_id(fragment: str) -> int:
     try:
-        user_id = base64.b64decode(user_id.encode())
-        user_id = int(user_id)
+        return int(base64.b64decode(fragment.encode()))
     except (ValueError, binascii.Error):
         raise HTTPError(401, 'Failed to get container volume for Authorization')
 
-    try:
-        user: User = User.objects(User.id == user_id).get()
-    except:
-        raise HTTPError(401, 'Object for Authorization not found')
 
-    signer = itsdangerous.TimestampSigner(user.password)
+def is_server_signed(token: str) -> bool:
+    # legacy tokens are `id.timestamp.signature`
+    return token.count('.') == 3
 
-    try:
-        signer.unsign(token)
 
-        return user
+def verify_token_signature(token: str) -> tuple[int, int]:
+    """Verify a server-signed token without any I/O.
+
+    Returns the user id and token generation the token was issued with,
+    checking that the generation is still current is left to the caller.
+    """
+    if auth_key is None:
+        raise HTTPError(401, 'Signature on Authorization is Invalid')
+
+    try:
+        payload = _server_signer().unsign(token).decode()
     except (itsdangerous.BadSignature):
         raise HTTPError(401, 'Signature on Authorization is Invalid')
 
+    user_id, generation = payload.split('.')
+    return _decode_user_id(user_id), int(generation)
+
+
+def token_identity(token: str | None) -> int:
+    """Get the id of the user ``token`` belongs to.
+
+    Server-signed tokens are identified without touching the database,
+    legacy ones are fully verified.
+    """
+    if token is not None and is_server_signed(token):
+        user_id, _ = verify_token_signature(token)
+        return user_id
+
+    return verify_token(token=token).id
+
+
+# verified tokens, shared between requests on this worker.
+# a token stays usable here for up to TOKEN_CACHE_TTL seconds after
+# another worker has invalidated it.
+token_cache = TTLCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('TOKEN_CACHE_TTL', '30')),
+)
+
+
+def _request_memo() -> dict[str, 'AuthUser | HTTPError'] | None:
+    if not has_request_context():
+        return None
+
+    if 'verified_tokens' not in g:
+        g.verified_tokens = {}
+
+    return g.verified_tokens
+
+
+def verify_token(token: str | None) -> 'AuthUser':
+    # the rate limiter and the route both authorize the same token,
+    # so the outcome is kept for the rest of the request.
+    memo = _request_memo()
+
+    if memo is not None and token in memo:
+        result = memo[token]
+
+        if isinstance(result, HTTPError):
+            raise result
+
+        return result
+
+    try:
+        user = _verify_token(token)
+    except HTTPError as exc:
+        if memo is not None:
+            memo[token] = exc
+        raise
+
+    if memo is not None:
+        memo[token] = user
+
+    return user
+
+
+def _verify_token(token: str | None) -> 'AuthUser':
+    if token is None:
+        raise HTTPError(401, 'Authorization is invalid')
+
+    cached: AuthUser | None = token_cache.get(token)
+
+    if cached is not None:
+        return cached
+
+    if is_server_signed(token):
+        user_id, generation = verify_token_signature(token)
+    else:
+        user_id = _decode_user_id(token.split('.')[0])
+        generation = None
+
+    # statements imports the models from this module
+    from derailedapi.statements import fetch_auth_user
+
+    user = fetch_auth_user(user_id)
+
+    if user is None:
+        raise HTTPError(401, 'Object for Authorization not found')
+
+    if generation is None:
+        signer = itsdangerous.TimestampSigner(user.password)
+
+        try:
+            signer.unsign(token)
+        except (itsdangerous.BadSignature):
+            raise HTTPError(401, 'Signature on Authorization is Invalid')
+    elif generation != (user.token_generation or 0):
+        raise HTTPError(401, 'Authorization has been revoked')
+
+    token_cache.set(token, user)
+    return user
+
+
+def invalidate_user(user_id: int) -> None:
+    """Forget every verified token belonging to ``user_id`` on this worker."""
+    token_cache.evict(lambda user: user.id == user_id)
+
+    memo = _request_memo()
+
+    if memo is not None:
+        for token in [t for t, u in memo.items() if getattr(u, 'id', None) == user_id]:
+            del memo[token]
+
+
+class SchemaMigration(models.Model):
+    __table_name__ = 'schema_migrations'
+    version: int = columns.Integer(primary_key=True)
+    name: str = columns.Text()
+    # set by the box which runs the migration, before it starts
+    claimed_at = columns.DateTime()
+    # null until it finished
+    applied_at = columns.DateTime()
+
 
 def sync_tables():
     management.sync_table(User)
+    management.sync_table(Credential)
+    management.sync_table(DiscriminatorAllocation)
     management.sync_table(GuildPosition)
     management.sync_table(Settings)
     management.sync_table(RecoveryCode)
     management.sync_table(Relationship)
+    management.sync_table(LegacyRelationship)
+    management.sync_table(RelationshipCount)
     management.sync_table(Activity)
+    management.sync_table(Channel)
+    management.sync_table(Recipient)
+    management.sync_table(GroupDMChannel)
+    management.sync_table(DMChannelByPair)
+    management.sync_table(ChannelByUser)
+    management.sync_table(Message)
@@ -17,49 +17,154 @@ import os
 import threading
 import time
 
+# bits 12-16 and 17-21 of a snowflake, after the 12 sequence bits
+MAX_WORKER_ID = 31
+MAX_PROCESS_ID = 31
+MAX_SEQUENCE = 4095
+# how far the clock may go back before ids are borrowed from the
+# future instead of waiting for it to catch up
+MAX_CLOCK_WAIT_MS = 10
+
 
 class SnowflakeFactory:
-    def __init__(self) -> None:
+    """Forges 64-bit snowflakes.
+
+    The layout is ``timestamp(42) | worker(5) | process(5) | sequence(12)``.
+    ``worker_id`` defaults to ``SNOWFLAKE_WORKER_ID``, ``process_id`` to
+    ``SNOWFLAKE_PROCESS_ID`` or the pid, every process forging ids at the
+    same time needs a distinct pair of them. Under gunicorn each box needs
+    its own ``SNOWFLAKE_WORKER_ID`` and the workers get a process id from
+    `process_slot` (see gunicorn.conf.py), pids modulo 32 collide.
+    """
+
+    def __init__(
+        self, worker_id: int | None = None, process_id: int | None = None
+    ) -> None:
         self._epoch: int = 1641042000000
-        self._incrementation = 0
         self._bucket_size = 1000 * 60 * 60 * 24 * 4
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
 
-    def forge(self) -> int:
-        current_ms = int(time.time() * 1000)
-        epoch = current_ms - self._epoch << 22
+        if worker_id is None:
+            worker_id = int(os.getenv('SNOWFLAKE_WORKER_ID') or 0)
+
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'worker_id must be between 0 and {MAX_WORKER_ID}')
+
+        self._worker_id = worker_id
+        self._fixed_process_id = process_id
+        self._process_id = self._resolve_process_id()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _resolve_process_id(self) -> int:
+        process_id = self._fixed_process_id
+
+        if process_id is None:
+            env = os.getenv('SNOWFLAKE_PROCESS_ID')
+            process_id = int(env) if env else os.getpid() % (MAX_PROCESS_ID + 1)
+
+        if not 0 <= process_id <= MAX_PROCESS_ID:
+            raise ValueError(f'process_id must be between 0 and {MAX_PROCESS_ID}')
+
+        return process_id
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self.refresh_process_id()
+
+    def refresh_process_id(self) -> None:
+        """Pick up a ``SNOWFLAKE_PROCESS_ID`` set after this was created."""
+        with self._lock:
+            self._process_id = self._resolve_process_id()
+
+    def _now(self) -> int:
+        return int(time.time() * 1000)
+
+    def _tick(self) -> None:
+        # must hold the lock
+        now = self._now()
+
+        if now > self._last_ms:
+            self._last_ms = now
+            self._sequence = 0
+            return
 
-        curthread = threading.current_thread().ident
-        assert (
-            curthread is not None
-        )  # NOTE: done for typing purposes, shouldn't ever actually be None.
+        # same millisecond, or the clock went back: keep counting on the
+        # last timestamp so ids never repeat or go backwards.
+        self._sequence += 1
 
-        epoch |= (curthread % 32) << 17
-        epoch |= (os.getpid() % 32) << 12
+        if self._sequence <= MAX_SEQUENCE:
+            return
 
-        epoch |= self._incrementation % 4096
+        if self._last_ms - now > MAX_CLOCK_WAIT_MS:
+            self._last_ms += 1
+        else:
+            while now <= self._last_ms:
+                time.sleep(0.0001)
+                now = self._now()
 
-        if self._incrementation == 9000000000:
-            self._incrementation = 0
+            self._last_ms = now
 
-        self._incrementation += 1
+        self._sequence = 0
 
-        return epoch
+    def _compose(self) -> int:
+        return (
+            (self._last_ms - self._epoch) << 22
+            | self._worker_id << 17
+            | self._process_id << 12
+            | self._sequence
+        )
+
+    def forge(self) -> int:
+        with self._lock:
+            self._tick()
+            return self._compose()
+
+    def forge_many(self, n: int) -> list[int]:
+        ids = []
+
+        with self._lock:
+            for _ in range(n):
+                self._tick()
+                ids.append(self._compose())
+
+        return ids
 
     def make_bucket(self, epoch: int) -> int:
         timestamp = epoch >> 22
         return timestamp // self._bucket_size
 
     def make_buckets(self, start_id, end_id=None):
+        if end_id is None:
+            # nothing can have been forged past the current millisecond
+            end_id = (self._now() - self._epoch) << 22
+
         return range(self.make_bucket(start_id), self.make_bucket(end_id) + 1)
 
 
+# the most processes of one box which can forge ids at the same time
+MAX_PROCESSES = MAX_PROCESS_ID + 1
+
+
+def process_slot(taken: set[int]) -> int:
+    """The lowest process id not in ``taken``."""
+    for slot in range(MAX_PROCESSES):
+        if slot not in taken:
+            return slot
+
+    raise RuntimeError(f'no more than {MAX_PROCESSES} processes can forge ids')
+
+
 forger = SnowflakeFactory()
 
 
 if __name__ == '__main__':
-    while True:
-        import sys
+    import sys
 
+    while True:
         enforgement = forger.forge()
         enforged_bucket = forger.make_bucket(enforgement)
 
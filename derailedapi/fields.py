@@ -0,0 +1,40 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from typing import Any
+
+from apiflask.fields import Integer
+from flask import current_app, has_app_context
+
+
+def snowflakes_as_str() -> bool:
+    return has_app_context() and current_app.config.get('JSON_SNOWFLAKES_AS_STR', False)
+
+
+class Snowflake(Integer):
+    """An id, dumped as a str when ``JSON_SNOWFLAKES_AS_STR`` is set.
+
+    JavaScript numbers lose precision past 2**53, which snowflakes easily
+    pass. Every id is a str then, not only the ones past it, so clients
+    can rely on the type. Loading accepts either.
+    """
+
+    def _serialize(self, value: Any, attr: Any, obj: Any, **kwargs) -> Any:
+        value = super()._serialize(value, attr, obj, **kwargs)
+
+        if value is None or not snowflakes_as_str():
+            return value
+
+        return str(value)
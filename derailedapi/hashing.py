@@ -0,0 +1,97 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# argon2 takes tens of milliseconds of CPU per call, under gevent that
+# would freeze every other greenlet in the worker. It runs in native
+# threads instead, argon2 releases the GIL while hashing.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from apiflask import HTTPError
+from argon2 import PasswordHasher
+
+from .instrumentation import timed
+from .metrics import hash_timer
+
+hasher = PasswordHasher()
+
+HASH_OFFLOAD = os.getenv('HASH_OFFLOAD', 'true') == 'true'
+HASH_POOL_SIZE = int(os.getenv('HASH_POOL_SIZE', str(os.cpu_count() or 1)))
+# hashes running or waiting for a thread, past this requests get a 503
+HASH_QUEUE_DEPTH = int(os.getenv('HASH_QUEUE_DEPTH', '64'))
+
+_queue_slots = threading.BoundedSemaphore(HASH_QUEUE_DEPTH)
+_pool: Any = None
+_pool_lock = threading.Lock()
+
+
+def _gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    return monkey.is_module_patched('threading')
+
+
+def _get_pool() -> Any:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            if _gevent_patched():
+                # a patched ThreadPoolExecutor would only spawn greenlets
+                from gevent.threadpool import ThreadPool
+
+                _pool = ThreadPool(HASH_POOL_SIZE)
+            else:
+                _pool = ThreadPoolExecutor(
+                    HASH_POOL_SIZE, thread_name_prefix='derailed-hash'
+                )
+
+        return _pool
+
+
+def _run(operation: str, func: Callable[..., Any], *args: Any) -> Any:
+    with timed('hash'), hash_timer(operation):
+        return _offload(func, *args)
+
+
+def _offload(func: Callable[..., Any], *args: Any) -> Any:
+    if not HASH_OFFLOAD:
+        return func(*args)
+
+    if not _queue_slots.acquire(blocking=False):
+        raise HTTPError(503, 'Too many password operations are queued, try again')
+
+    try:
+        pool = _get_pool()
+
+        if isinstance(pool, ThreadPoolExecutor):
+            return pool.submit(func, *args).result()
+
+        return pool.apply(func, args)
+    finally:
+        _queue_slots.release()
+
+
+def hash_password(password: str) -> str:
+    return _run('hash', hasher.hash, password)
+
+
+def verify_password(hash: str, password: str) -> bool:
+    return _run('verify', hasher.verify, hash, password)
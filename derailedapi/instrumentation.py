@@ -0,0 +1,202 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Where a request's time went.
+#
+# With REQUEST_TIMING=true every response gets a `Server-Timing` header
+# splitting its time into db, hash, serialize and rate-limit, and requests
+# slower than SLOW_REQUEST_MS are logged with the queries they sent.
+# Disabled, nothing is hooked and `timed` hands out a shared no-op.
+import logging
+import os
+import time
+from functools import wraps
+from typing import Any, Callable
+
+from flask import Flask, Response, g, has_request_context, request
+
+log = logging.getLogger(__name__)
+
+ENABLED = os.getenv('REQUEST_TIMING', 'false') == 'true'
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '500'))
+
+
+class RequestTimings:
+    __slots__ = ('started', 'durations', 'queries')
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.durations: dict[str, float] = {}
+        # (query, seconds), appended from the driver's event loop
+        self.queries: list[tuple[str, float]] = []
+
+    def add(self, category: str, seconds: float) -> None:
+        self.durations[category] = self.durations.get(category, 0.0) + seconds
+
+    def header(self, total: float) -> str:
+        metrics = []
+
+        if self.queries:
+            db = sum(seconds for _, seconds in self.queries)
+            metrics.append(f'db;dur={db * 1000:.2f};desc="{len(self.queries)} queries"')
+
+        for category, seconds in self.durations.items():
+            metrics.append(f'{category};dur={seconds * 1000:.2f}')
+
+        metrics.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(metrics)
+
+
+def current() -> RequestTimings | None:
+    if not ENABLED or not has_request_context():
+        return None
+
+    timings = g.get('request_timings')
+
+    if timings is None:
+        timings = g.request_timings = RequestTimings()
+
+    return timings
+
+
+class _Timer:
+    __slots__ = ('category', 'started')
+
+    def __init__(self, category: str) -> None:
+        self.category = category
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc: Any) -> None:
+        timings = current()
+
+        if timings is not None:
+            timings.add(self.category, time.perf_counter() - self.started)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timed(category: str) -> _Timer | _NoTimer:
+    """Add the time spent in the block to ``category`` of this request."""
+    return _Timer(category) if ENABLED else _NO_TIMER
+
+
+def _query_text(query: Any) -> str:
+    query = getattr(query, 'prepared_statement', query)
+    return getattr(query, 'query_string', None) or str(query)
+
+
+def _on_request(future: Any) -> None:
+    timings = current()
+
+    if timings is None:
+        return
+
+    started = time.perf_counter()
+    text = _query_text(getattr(future, 'query', None))
+
+    def done(_: Any) -> None:
+        timings.queries.append((text, time.perf_counter() - started))
+
+    future.add_callbacks(done, done)
+
+
+def instrument_session(session: Any) -> None:
+    """Count and time every query ``session`` sends during a request."""
+    if ENABLED:
+        session.add_request_init_listener(_on_request)
+
+
+def _instrument_strategy(strategy: Any) -> None:
+    def wrap(func: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with timed('rate-limit'):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    for name in ('hit', 'test', 'get_window_stats'):
+        setattr(strategy, name, wrap(getattr(strategy, name)))
+
+
+def _start() -> None:
+    g.request_timings = RequestTimings()
+
+
+def _report(timings: RequestTimings, method: str, path: str, endpoint: str) -> None:
+    total = time.perf_counter() - timings.started
+
+    if total * 1000 < SLOW_REQUEST_MS:
+        return
+
+    queries = ''.join(
+        f'\n  {seconds * 1000:8.2f}ms {text}' for text, seconds in timings.queries
+    )
+    log.warning(
+        'slow request: %s %s (%s) %.2fms, %s%s',
+        method,
+        path,
+        endpoint,
+        total * 1000,
+        timings.header(total),
+        queries,
+    )
+
+
+def _finish(response: Response) -> Response:
+    timings = g.get('request_timings')
+
+    if timings is None:
+        return response
+
+    total = time.perf_counter() - timings.started
+    response.headers['Server-Timing'] = timings.header(total)
+    args = (timings, request.method, request.path, request.endpoint)
+
+    if response.is_streamed:
+        # the header only covers what came before the body, the log waits
+        # for the queries sent while it streams
+        response.call_on_close(lambda: _report(*args))
+    else:
+        _report(*args)
+
+    return response
+
+
+def init_app(app: Flask, limiter: Any = None) -> None:
+    """Hook into ``app``, after ``limiter`` was initialized for it."""
+    if not ENABLED:
+        return
+
+    # first, so the rate limit checks are inside the request's time
+    app.before_request_funcs.setdefault(None, []).insert(0, _start)
+    # after_request runs backwards, last so the limiter's headers count too
+    app.after_request_funcs.setdefault(None, []).insert(0, _finish)
+
+    if limiter is not None:
+        _instrument_strategy(limiter.limiter)
@@ -13,7 +13,39 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from typing import Any
+
 import orjson
+from flask import Response, current_app
+
+from .instrumentation import timed
+
+# options every payload is serialized with
+DEFAULT_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def dumps(obj: Any, option: int = DEFAULT_OPTIONS) -> bytes:
+    return orjson.dumps(obj, option=option)
+
+
+def json_response(
+    obj: Any,
+    status: int = 200,
+    option: int = DEFAULT_OPTIONS,
+    headers: dict[str, str] | None = None,
+) -> Response:
+    """Build a response straight from orjson's bytes.
+
+    ``obj`` may already be serialized bytes. Routes returning this skip
+    apiflask's output schema, so ``obj`` has to already be in its shape,
+    ids already strs when ``JSON_SNOWFLAKES_AS_STR`` is set.
+    """
+    if not isinstance(obj, (bytes, bytearray, memoryview)):
+        obj = dumps(obj, option=option)
+
+    return current_app.response_class(
+        obj, status=status, headers=headers, mimetype='application/json'
+    )
 
 
 class ORJSONDecoder:
@@ -27,9 +59,19 @@ class ORJSONDecoder:
 
 class ORJSONEncoder:
     def __init__(self, **kwargs):
-        # eventually take into consideration when serializing
         self.options = kwargs
+        self.option = DEFAULT_OPTIONS
+        self.default = kwargs.get('default')
+
+        if kwargs.get('sort_keys'):
+            self.option |= orjson.OPT_SORT_KEYS
+
+        if kwargs.get('indent'):
+            self.option |= orjson.OPT_INDENT_2
 
     def encode(self, obj):
         # decode back to str, as orjson returns bytes
-        return orjson.dumps(obj).decode('utf-8')
+        with timed('serialize'):
+            return orjson.dumps(obj, default=self.default, option=self.option).decode(
+                'utf-8'
+            )
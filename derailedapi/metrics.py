@@ -0,0 +1,217 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Prometheus metrics, exposed on GET /metrics with METRICS=true.
+#
+# Under gunicorn every worker writes its samples to files in
+# PROMETHEUS_MULTIPROC_DIR and a scrape of any worker reads all of them,
+# the directory has to be emptied before gunicorn starts (see docker.py).
+import contextlib
+import os
+import time
+from typing import Any, ContextManager
+
+from apiflask import APIBlueprint, HTTPError
+from cassandra import OperationTimedOut
+from cassandra.policies import RetryPolicy
+from flask import Flask, Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+ENABLED = os.getenv('METRICS', 'false') == 'true'
+# when set, scrapes need `Authorization: Bearer <token>`
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+# how often a worker refreshes its connection pool gauges
+POOL_INTERVAL = float(os.getenv('METRICS_POOL_INTERVAL', '5'))
+
+REQUEST_SECONDS = Histogram(
+    'derailed_request_duration_seconds',
+    'Time spent handling requests',
+    ['blueprint', 'endpoint', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+RESPONSES = Counter(
+    'derailed_responses_total',
+    'Responses sent, by status code',
+    ['endpoint', 'method', 'status'],
+)
+RATELIMIT_REJECTIONS = Counter(
+    'derailed_ratelimit_rejections_total',
+    'Requests rejected by the rate limiter',
+    ['endpoint', 'limit'],
+)
+HASH_SECONDS = Histogram(
+    'derailed_password_hash_seconds',
+    'Time spent hashing and verifying passwords, queueing included',
+    ['operation'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+SCYLLA_IN_FLIGHT = Gauge(
+    'derailed_scylla_in_flight_requests',
+    'Requests in flight on the connections to a host',
+    ['host'],
+    multiprocess_mode='livesum',
+)
+SCYLLA_CONNECTIONS = Gauge(
+    'derailed_scylla_open_connections',
+    'Open connections to a host',
+    ['host'],
+    multiprocess_mode='livesum',
+)
+SCYLLA_TIMEOUTS = Counter(
+    'derailed_scylla_timeouts_total',
+    'Queries which timed out, by where',
+    ['kind'],
+)
+SCYLLA_RETRIES = Counter(
+    'derailed_scylla_retries_total',
+    'Queries retried by the retry policy, by why',
+    ['reason'],
+)
+
+metrics = APIBlueprint('metrics', __name__)
+
+
+@metrics.get('/metrics')
+@metrics.doc(hide=True)
+def expose():
+    if METRICS_TOKEN is not None:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            raise HTTPError(401, 'Invalid metrics token')
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def hash_timer(operation: str) -> ContextManager[Any]:
+    if not ENABLED:
+        return contextlib.nullcontext()
+
+    return HASH_SECONDS.labels(operation).time()
+
+
+class CountingRetryPolicy(RetryPolicy):
+    """The default retry policy, counting timeouts and retries."""
+
+    def _count(self, reason: str, decision: tuple) -> tuple:
+        if decision[0] in (self.RETRY, self.RETRY_NEXT_HOST):
+            SCYLLA_RETRIES.labels(reason).inc()
+
+        return decision
+
+    def on_read_timeout(self, *args: Any, **kwargs: Any) -> tuple:
+        SCYLLA_TIMEOUTS.labels('read').inc()
+        return self._count('read_timeout', super().on_read_timeout(*args, **kwargs))
+
+    def on_write_timeout(self, *args: Any, **kwargs: Any) -> tuple:
+        SCYLLA_TIMEOUTS.labels('write').inc()
+        return self._count('write_timeout', super().on_write_timeout(*args, **kwargs))
+
+    def on_unavailable(self, *args: Any, **kwargs: Any) -> tuple:
+        return self._count('unavailable', super().on_unavailable(*args, **kwargs))
+
+    def on_request_error(self, *args: Any, **kwargs: Any) -> tuple:
+        return self._count('request_error', super().on_request_error(*args, **kwargs))
+
+
+def _on_request(future: Any) -> None:
+    def failed(exc: Exception) -> None:
+        if isinstance(exc, OperationTimedOut):
+            SCYLLA_TIMEOUTS.labels('client').inc()
+
+    future.add_callbacks(lambda _: None, failed)
+
+
+def instrument_session(session: Any) -> None:
+    if ENABLED:
+        session.add_request_init_listener(_on_request)
+
+
+_pools_refreshed_at = 0.0
+
+
+def _refresh_pools() -> None:
+    global _pools_refreshed_at
+
+    now = time.monotonic()
+
+    if now - _pools_refreshed_at < POOL_INTERVAL:
+        return
+
+    _pools_refreshed_at = now
+
+    from cassandra.cqlengine import connection
+
+    session = connection.get_session()
+
+    if session is None:
+        return
+
+    for host, state in session.get_pool_state().items():
+        name = str(getattr(host, 'endpoint', host))
+        SCYLLA_IN_FLIGHT.labels(name).set(sum(state['in_flights']))
+        SCYLLA_CONNECTIONS.labels(name).set(state['open_count'])
+
+
+def _start() -> None:
+    g.metrics_started = time.perf_counter()
+
+
+def _finish(response: Response, limiter: Any) -> Response:
+    started = g.get('metrics_started')
+
+    if started is None:
+        return response
+
+    # unmatched urls would give every probed path its own series
+    endpoint = request.endpoint or 'unmatched'
+    method = request.method
+    REQUEST_SECONDS.labels(request.blueprint or '', endpoint, method).observe(
+        time.perf_counter() - started
+    )
+    RESPONSES.labels(endpoint, method, str(response.status_code)).inc()
+
+    if response.status_code == 429 and limiter is not None:
+        limit = limiter.current_limit
+
+        if limit is not None and limit.breached:
+            RATELIMIT_REJECTIONS.labels(endpoint, str(limit.limit)).inc()
+
+    _refresh_pools()
+    return response
+
+
+def init_app(app: Flask, limiter: Any = None) -> None:
+    if not ENABLED:
+        return
+
+    app.register_blueprint(metrics)
+    app.before_request_funcs.setdefault(None, []).insert(0, _start)
+    app.after_request_funcs.setdefault(None, []).insert(
+        0, lambda response: _finish(response, limiter)
+    )
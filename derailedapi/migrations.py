@@ -0,0 +1,137 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Schema changes, run once per deploy with `python -m derailedapi.migrations`
+# instead of by every worker on boot.
+#
+# Tables are synced on every run, which only ever adds what is missing.
+# Changes to existing data go at the end of MIGRATIONS, applied versions
+# are recorded in `schema_migrations` and never rerun.
+#
+# Boxes deploying together race for each version with a lightweight
+# transaction, the one which claims it runs it and the others wait for it
+# to finish. Migrations like `counters.recount` are not idempotent when
+# run concurrently, so a version must never run twice.
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Callable
+
+from cassandra.cqlengine import management
+from cassandra.cqlengine.query import LWTException
+
+from .database import SchemaMigration, sync_tables
+from .relationships import counters
+from .relationships import migrate as relationships_migration
+from .users import migrate as users_migration
+
+
+def copy_relationships() -> None:
+    relationships_migration.migrate()
+    counters.recount()
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[], None]]] = [
+    (1, 'copy relationships into relationships_by_user', copy_relationships),
+    (2, 'backfill credentials from users', users_migration.backfill),
+]
+
+
+# how long to wait for a migration another box is running
+WAIT_SECONDS = float(os.getenv('MIGRATION_WAIT_SECONDS', '600'))
+
+
+def applied_versions() -> set[int]:
+    return {
+        m.version
+        for m in SchemaMigration.objects.all().limit(None)
+        if m.applied_at is not None
+    }
+
+
+def claim(version: int, name: str) -> bool:
+    try:
+        SchemaMigration.if_not_exists().create(
+            version=version, name=name, claimed_at=datetime.utcnow()
+        )
+    except LWTException:
+        return False
+
+    return True
+
+
+def wait_for(version: int) -> None:
+    deadline = time.monotonic() + WAIT_SECONDS
+
+    while True:
+        migration = SchemaMigration.objects(version=version).first()
+
+        if migration is None:
+            raise RuntimeError(f'migration {version} failed on another box')
+
+        if migration.applied_at is not None:
+            return
+
+        if time.monotonic() >= deadline:
+            raise RuntimeError(
+                f'migration {version} was claimed at {migration.claimed_at} and '
+                'has not finished, if whatever ran it died delete its '
+                '`schema_migrations` row and deploy again'
+            )
+
+        time.sleep(1)
+
+
+def migrate() -> list[int]:
+    sync_tables()
+    management.sync_table(SchemaMigration)
+    applied = applied_versions()
+    ran = []
+
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+
+        if not claim(version, name):
+            print(f'waiting for {version}: {name}', file=sys.stderr)
+            wait_for(version)
+            continue
+
+        print(f'applying {version}: {name}', file=sys.stderr)
+
+        try:
+            func()
+        except BaseException:
+            # let the next deploy try again
+            SchemaMigration.objects(version=version).delete()
+            raise
+
+        SchemaMigration.objects(version=version).update(applied_at=datetime.utcnow())
+        ran.append(version)
+
+    return ran
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    from .database import connect
+
+    connect()
+    ran = migrate()
+    print(f'{len(ran)} migrations applied', file=sys.stderr)
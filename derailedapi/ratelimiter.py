@@ -18,25 +18,28 @@ import os
 from flask import request
 from flask_limiter import Limiter, util
 
-from .database import verify_token
+from . import strategies  # noqa: F401, registers our strategies
+from .database import token_identity
 
 
 def key_func():
     auth = request.headers.get('Authorization', None)
 
     try:
-        user = verify_token(token=auth)
+        user_id = token_identity(token=auth)
     except:
         return util.get_remote_address()
     else:
-        return str(user.id)
+        return str(user_id)
 
 
 limiter = Limiter(
     key_func=key_func,
     key_prefix='derailed_limiting',
     headers_enabled=True,
-    strategy='fixed-window-elastic-expiry',
+    # `local-fixed-window-elastic-expiry` spends most hits without a storage
+    # round trip, see strategies.py
+    strategy=os.getenv('RATELIMIT_STRATEGY') or 'fixed-window-elastic-expiry',
     storage_uri=os.getenv('STORAGE_URI'),
     default_limits=['50/second'],
 )
@@ -0,0 +1,104 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from collections import Counter
+
+from ..database import Relationship, RelationshipCount
+from ..statements import (
+    Deferred,
+    adjust_relationship_count_async,
+    fetch_relationship_count,
+)
+
+
+def _adjust_async(deltas: dict[int, int]) -> list[Deferred[None]]:
+    # one partition per counter, a batch would only add a coordinator hop
+    return [
+        adjust_relationship_count_async(user_id, delta)
+        for user_id, delta in deltas.items()
+        if delta
+    ]
+
+
+def _adjust(deltas: dict[int, int]) -> None:
+    for pending in _adjust_async(deltas):
+        pending.result()
+
+
+# counts are per row, each side of a relationship is adjusted on its own
+def relationship_created(user_id: int) -> None:
+    _adjust({user_id: 1})
+
+
+def relationships_created_async(user_ids: list[int]) -> list[Deferred[None]]:
+    """`relationship_created` for every row in ``user_ids``, sent at once."""
+    return _adjust_async(Counter(user_ids))
+
+
+def relationship_deleted(user_id: int) -> None:
+    _adjust({user_id: -1})
+
+
+def relationships_deleted(user_ids: list[int]) -> None:
+    """`relationship_deleted` for every row in ``user_ids``, in one batch."""
+    _adjust({user_id: -count for user_id, count in Counter(user_ids).items()})
+
+
+def get_relationship_count(user_id: int) -> int:
+    return fetch_relationship_count(user_id)
+
+
+def recount() -> int:
+    """Recompute every counter from the `relationships_by_user` table.
+
+    Scans both tables in full, run it out of band when counters drift.
+    Returns the amount of counters which were corrected.
+    """
+    actual: Counter[int] = Counter()
+
+    for relationship in Relationship.objects.all().limit(None):
+        actual[relationship.user_id] += 1
+
+    stored: Counter[int] = Counter()
+
+    for row in RelationshipCount.objects.all().limit(None):
+        stored[row.user_id] = row.count or 0
+
+    deltas = {
+        user_id: actual[user_id] - stored[user_id]
+        for user_id in actual.keys() | stored.keys()
+        if actual[user_id] != stored[user_id]
+    }
+
+    _adjust(deltas)
+
+    return len(deltas)
+
+
+if __name__ == '__main__':
+    import sys
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    from ..database import connect
+
+    if sys.argv[1:] != ['recount']:
+        print('usage: python -m derailedapi.relationships.counters recount')
+        sys.exit(1)
+
+    connect()
+    print(f'corrected {recount()} counters', file=sys.stderr)
@@ -0,0 +1,121 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Copies `relationships` into `relationships_by_user` while the API keeps serving.
+#
+# Rows are copied with the write time they had in the old table, so anything
+# the API wrote or deleted in the new table since then always wins.
+# Progress is saved after every token range, running the command again
+# resumes from the first range that did not finish.
+import os
+import sys
+
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.cqlengine import connection
+from cassandra.query import SimpleStatement
+
+from ..database import LegacyRelationship, Relationship
+
+MIN_TOKEN = -(2**63)
+MAX_TOKEN = 2**63 - 1
+
+
+def token_ranges(chunks: int) -> list[tuple[int, int]]:
+    step = (MAX_TOKEN - MIN_TOKEN) // chunks
+    bounds = [MIN_TOKEN + step * i for i in range(chunks)] + [MAX_TOKEN]
+    return list(zip(bounds, bounds[1:]))
+
+
+def read_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path: str, completed: int) -> None:
+    tmp = path + '.tmp'
+
+    with open(tmp, 'w') as f:
+        f.write(str(completed))
+
+    os.replace(tmp, path)
+
+
+def migrate(
+    chunks: int = 256,
+    checkpoint: str = '.relationships-migration',
+    concurrency: int = 50,
+) -> int:
+    session = connection.get_session()
+    select = SimpleStatement(
+        f'SELECT user_id, target_id, type, WRITETIME(type) AS written_at '
+        f'FROM {LegacyRelationship.column_family_name()} '
+        f'WHERE token(user_id) > %s AND token(user_id) <= %s',
+        fetch_size=1000,
+    )
+    insert = session.prepare(
+        f'INSERT INTO {Relationship.column_family_name()} (user_id, target_id, type) '
+        f'VALUES (?, ?, ?) USING TIMESTAMP ?'
+    )
+
+    ranges = token_ranges(chunks)
+    copied = 0
+
+    for index in range(read_checkpoint(checkpoint), len(ranges)):
+        start, end = ranges[index]
+        rows = (
+            (row['user_id'], row['target_id'], row['type'], row['written_at'])
+            for row in session.execute(select, (start, end))
+            if row['target_id'] is not None and row['written_at'] is not None
+        )
+
+        results = execute_concurrent_with_args(
+            session, insert, rows, concurrency=concurrency, raise_on_first_error=True
+        )
+        copied += len(results)
+
+        write_checkpoint(checkpoint, index + 1)
+        print(f'range {index + 1}/{len(ranges)}: {copied} rows copied', file=sys.stderr)
+
+    return copied
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    from ..database import connect
+
+    parser = argparse.ArgumentParser(
+        description='Copy relationships into relationships_by_user.'
+    )
+    parser.add_argument('--chunks', type=int, default=256)
+    parser.add_argument('--checkpoint', default='.relationships-migration')
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    connect()
+    migrate(
+        chunks=args.chunks, checkpoint=args.checkpoint, concurrency=args.concurrency
+    )
+    print(
+        'done, run `python -m derailedapi.relationships.counters recount` next',
+        file=sys.stderr,
+    )
@@ -13,55 +13,77 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-from typing import Any
+import base64
+import binascii
+from typing import Any, Iterator
 
 from apiflask import APIBlueprint, HTTPError
 from apiflask.schemas import EmptySchema
+from cassandra import InvalidRequest
+from cassandra.cqlengine.query import BatchQuery, BatchType
+from cassandra.protocol import ProtocolException
+from flask import Response, current_app, stream_with_context
 
 from ..database import Relationship, Settings, User
 from ..enums import Relation
+from ..fields import snowflakes_as_str
+from ..json import dumps
+from ..ratelimiter import limiter
+from ..serializers import compile_schema, fast_output
+from ..statements import (
+    Deferred,
+    PublicUser,
+    delete_relationship_async,
+    fetch_public_user,
+    fetch_public_users_async,
+    fetch_relationship,
+    fetch_relationship_async,
+    fetch_relationship_count_async,
+    fetch_relationships,
+    fetch_relationships_page_async,
+    fetch_relationships_with_async,
+    fetch_settings_async,
+    insert_relationship,
+    insert_relationship_async,
+)
 from ..users.routes import authorize
 from ..users.schemas import Authorization, AuthorizationObject
+from .counters import (
+    relationship_deleted,
+    relationships_created_async,
+    relationships_deleted,
+)
 from .schemas import (
+    BulkRelationships,
+    BulkRelationshipsData,
+    BulkResult,
     MakeRelationship,
     MakeRelationshipData,
     ModifyRelationship,
     ModifyRelationshipData,
 )
 from .schemas import Relationship as RelationshipData
+from .schemas import RelationshipListing, RelationshipListingData
 
 relationships = APIBlueprint('relationships', __name__)
 
 
-# make sure these users have no passed their specific limit of 1000 relationships
-def didnt_pass_max_relationships(user: User, target: User):
-    target_setting: Settings = (
-        Settings.objects(Settings.user_id == target.id)
-        .only(['friend_requests_off'])
-        .get()
-    )
+# counted in rows the user owns, a friendship or pending request is one row
+# for each side, so this is 1000 relationships rather than 500
+MAX_RELATIONSHIPS = 1000
 
-    if target_setting.friend_requests_off:
-        raise HTTPError(400, 'This user has turned off friend requests')
 
-    user_main_relationships: int = Relationship.objects(
-        Relationship.user_id == user.id
-    ).count()
-    user_targeted_relationships: int = Relationship.objects(
-        Relationship.target_id == user.id
-    ).count()
+# make sure these users have no passed their specific limit of 1000 relationships
+def didnt_pass_max_relationships(
+    target_setting: Settings | None, user_count: int, target_count: int
+):
+    if target_setting is not None and target_setting.friend_requests_off:
+        raise HTTPError(400, 'This user has turned off friend requests')
 
-    if user_main_relationships + user_targeted_relationships == 1000:
+    if user_count >= MAX_RELATIONSHIPS:
         raise HTTPError(400, 'You have reached your maximum relationship limit')
 
-    target_main_relationships: int = Relationship.objects(
-        Relationship.user_id == target.id
-    ).count()
-    target_targeted_relationships: int = Relationship.objects(
-        Relationship.target_id == target.id
-    ).count()
-
-    if target_main_relationships + target_targeted_relationships == 1000:
+    if target_count >= MAX_RELATIONSHIPS:
         raise HTTPError(400, 'Target user has reached their maximum relationship limit')
 
 
@@ -73,9 +95,11 @@ def didnt_pass_max_relationships(user: User, target: User):
 @relationships.doc(tag='Relationships')
 def create_relationship(json: MakeRelationshipData, headers: AuthorizationObject):
     peer = authorize(headers['authorization'])
-    targets: list[User] = User.objects(
-        User.username == json['username'],
-    ).all()
+    targets: list[User] = (
+        User.objects(User.username == json['username'])
+        .only(['id', 'discriminator'])
+        .all()
+    )
     target: User | None = next(
         (ts for ts in targets if ts.discriminator == json['discriminator']),
         None,
@@ -87,16 +111,23 @@ def create_relationship(json: MakeRelationshipData, headers: AuthorizationObject
     if target.id == peer.id:
         raise HTTPError(400, 'You cannot friend yourself')
 
-    didnt_pass_max_relationships(user=peer, target=target)
+    # none of these depend on each other, so they are all sent at once
+    target_setting = fetch_settings_async(target.id)
+    user_count = fetch_relationship_count_async(peer.id)
+    target_count = fetch_relationship_count_async(target.id)
+    pending_peer_relation = fetch_relationship_async(peer.id, target.id)
+    pending_current_relation = fetch_relationship_async(target.id, peer.id)
+
+    didnt_pass_max_relationships(
+        target_setting=target_setting.result(),
+        user_count=user_count.result(),
+        target_count=target_count.result(),
+    )
+
+    peer_relation = pending_peer_relation.result()
 
     if json['type'] == Relation.FRIEND:
-        try:
-            peer_relation: Relationship = Relationship.objects(
-                Relationship.user_id == peer.id, Relationship.target_id == target.id
-            ).get()
-        except:
-            peer_relation = None
-        else:
+        if peer_relation is not None:
             if peer_relation.type == Relation.BLOCKED:
                 raise HTTPError(400, 'You have blocked this user')
             elif peer_relation.type == Relation.FRIEND:
@@ -104,27 +135,23 @@ def create_relationship(json: MakeRelationshipData, headers: AuthorizationObject
             elif peer_relation.type == Relation.OUTGOING:
                 raise HTTPError(400, 'You already sent a friend request to this user')
 
-        try:
-            # check if this user was blocked or is already friended
-            current_relation: Relationship = Relationship.objects(
-                Relationship.user_id == target.id, Relationship.target_id == peer.id
-            ).get()
-        except:
-            pass
-        else:
+        # check if this user was blocked or is already friended
+        current_relation = pending_current_relation.result()
+
+        if current_relation is not None:
             if current_relation.type == Relation.BLOCKED:
                 raise HTTPError(401, 'This user has blocked you')
             elif current_relation.type == Relation.FRIEND:
                 raise HTTPError(400, 'This user has already friended you')
     else:
-        try:
-            peer_relation: Relationship = Relationship.objects(
-                Relationship.user_id == peer.id, Relationship.target_id == target.id
-            ).get()
-        except:
-            peer_relation: Relationship = Relationship.create(
-                user_id=peer.id, target_id=target.id, type=Relation.BLOCKED
-            )
+        if peer_relation is None:
+            writes = [
+                insert_relationship_async(peer.id, target.id, Relation.BLOCKED),
+                *relationships_created_async([peer.id]),
+            ]
+
+            for write in writes:
+                write.result()
         else:
             if peer_relation.type == Relation.BLOCKED:
                 raise HTTPError(400, 'This user is already blocked')
@@ -133,9 +160,27 @@ def create_relationship(json: MakeRelationshipData, headers: AuthorizationObject
 
             peer_relation.update(type=Relation.BLOCKED)
 
+        return ''
+
+    created = [
+        user_id
+        for user_id, relation in (
+            (peer.id, peer_relation),
+            (target.id, current_relation),
+        )
+        if relation is None
+    ]
     # TODO: Send these as events
-    Relationship.create(user_id=peer.id, target_id=target.id, type=Relation.OUTGOING)
-    Relationship.create(user_id=target.id, target_id=peer.id, type=Relation.INCOMING)
+    writes = [
+        insert_relationship_async(peer.id, target.id, Relation.OUTGOING),
+        insert_relationship_async(target.id, peer.id, Relation.INCOMING),
+        *relationships_created_async(created),
+    ]
+
+    for write in writes:
+        write.result()
+
+    return ''
 
 
 @relationships.patch('/users/@me/relationships')
@@ -146,24 +191,18 @@ def create_relationship(json: MakeRelationshipData, headers: AuthorizationObject
 def modify_relationship(json: ModifyRelationshipData, headers: AuthorizationObject):
     peer = authorize(headers['authorization'])
 
-    try:
-        target: User = User.objects(User.id == json['user_id']).get()
-    except:
+    target = fetch_public_user(json['user_id'])
+
+    if target is None:
         raise HTTPError(400, 'Target user does not exist')
 
-    try:
-        peer_relationship: Relationship = Relationship.objects(
-            Relationship.user_id == peer.id, Relationship.target_id == target.id
-        ).get()
-    except:
+    peer_relationship = fetch_relationship(peer.id, target.id)
+
+    if peer_relationship is None:
         raise HTTPError(400, 'You do not have a relationship with this user')
 
     if peer_relationship.type == Relation.INCOMING:
-        target_relationship: Relationship = Relationship.objects(
-            Relationship.user_id == target.id, Relationship.target_id == peer.id
-        ).get()
-
-        target_relationship.update(type=Relation.FRIEND)
+        insert_relationship(target.id, peer.id, Relation.FRIEND)
         peer_relationship.update(type=Relation.FRIEND)
     else:
         raise HTTPError(400, 'You cannot modify this type of relationship')
@@ -178,63 +217,268 @@ def modify_relationship(json: ModifyRelationshipData, headers: AuthorizationObje
 def remove_relationship(user_id: int, headers: AuthorizationObject):
     peer = authorize(headers['authorization'])
 
-    try:
-        target: User = User.objects(User.id == user_id).get()
-    except:
+    target = fetch_public_user(user_id)
+
+    if target is None:
         raise HTTPError(404, 'Target user does not exist')
 
-    try:
-        peer_relation: Relationship = Relationship.objects(
-            Relationship.user_id == peer.id, Relationship.target_id == target.id
-        ).get()
-    except:
+    peer_relation = fetch_relationship(peer.id, target.id)
+
+    if peer_relation is None:
         raise HTTPError(400, 'You don\'t have a relationship with this user')
-    else:
-        peer_relation.delete()
 
-    try:
-        target_relationship: Relationship = Relationship.objects(
-            Relationship.user_id == target.id, Relationship.target_id == peer.id
-        ).get()
-    except:
-        # blocked users
-        pass
-    else:
+    peer_relation.delete()
+    relationship_deleted(peer.id)
+
+    target_relationship = fetch_relationship(target.id, peer.id)
+
+    # blocked users
+    if target_relationship is not None:
         if target_relationship.type != Relation.BLOCKED:
             target_relationship.delete()
+            relationship_deleted(target.id)
 
     return ''
 
 
+# how many users get fetched in a single `IN` query
+USER_BATCH_SIZE = 100
+
+
+def get_users(user_ids: list[int]) -> dict[int, PublicUser]:
+    unique_ids = list(dict.fromkeys(user_ids))
+    users: dict[int, PublicUser] = {}
+
+    # every batch is sent before the first one is waited on
+    pending = [
+        fetch_public_users_async(unique_ids[i : i + USER_BATCH_SIZE])
+        for i in range(0, len(unique_ids), USER_BATCH_SIZE)
+    ]
+
+    for batch in pending:
+        for user in batch.result():
+            users[user.id] = user
+
+    return users
+
+
 def easily_productionify_relationship(
-    relationship: Relationship
+    relationship: Relationship, target: PublicUser
 ) -> dict[Any, Any]:
-    ret = dict(relationship)
+    return {'type': relationship.type, 'user': target._asdict()}
 
-    ret.pop('user_id')
 
-    target: User = User.objects(User.id == ret.pop('target_id')).get()
-    dtarg = dict(target)
+def encode_cursor(paging_state: bytes) -> str:
+    return base64.urlsafe_b64encode(paging_state).decode()
+
+
+def decode_cursor(cursor: str) -> bytes:
+    try:
+        state = base64.b64decode(cursor.encode(), altchars=b'-_', validate=True)
+    except (binascii.Error, ValueError):
+        state = b''
 
-    dtarg.pop('email')
-    dtarg.pop('password')
-    dtarg.pop('verified')
+    if not state:
+        raise HTTPError(400, 'Invalid cursor')
 
-    ret['user'] = dtarg
-    return ret
+    return state
+
+
+Page = tuple[list[Relationship], bytes | None]
+
+
+def read_page(pending: Deferred[Page]) -> Page:
+    # the query is bound to the caller's partition, a forged paging
+    # state can only fail here, not reach anyone else's rows
+    try:
+        return pending.result()
+    except (InvalidRequest, ProtocolException):
+        raise HTTPError(400, 'Invalid cursor')
+
+
+def productionify_page(relationships: list[Relationship]) -> list[dict[Any, Any]]:
+    targets = get_users([pr.target_id for pr in relationships])
+
+    return [
+        easily_productionify_relationship(relationship=pr, target=targets[pr.target_id])
+        for pr in relationships
+        if pr.target_id in targets
+    ]
+
+
+def stream_relationships(user_id: int, paging_state: bytes | None) -> Response:
+    """Stream the JSON array a page of ``USER_BATCH_SIZE`` at a time.
+
+    Errors past the first page can only cut the array short, the status
+    has already been sent by then.
+    """
+    dump = compile_schema(RelationshipData, snowflakes_as_str())
+    first = read_page(
+        fetch_relationships_page_async(user_id, USER_BATCH_SIZE, paging_state)
+    )
+
+    def generate() -> Iterator[bytes]:
+        page, state = first
+        separator = b''
+        yield b'['
+
+        while True:
+            # the next page is read while this one's users are
+            pending = (
+                fetch_relationships_page_async(user_id, USER_BATCH_SIZE, state)
+                if state
+                else None
+            )
+            items = [dumps(dump(item)) for item in productionify_page(page)]
+
+            if items:
+                yield separator + b','.join(items)
+                separator = b','
+
+            if pending is None:
+                break
+
+            page, state = pending.result()
+
+        yield b']'
+
+    # later pages still count towards the request's queries
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype='application/json'
+    )
 
 
 @relationships.get('/users/@me/relationships')
+@relationships.input(RelationshipListing, 'query')
 @relationships.input(Authorization, 'headers')
-@relationships.output(RelationshipData(many=True), description='Your relationships')
+@relationships.output(
+    RelationshipData(many=True),
+    description=(
+        'Your relationships. With `limit`, the `X-Next-Cursor` header is the '
+        '`after` of the next page. `stream` sends every relationship from '
+        '`after` on as it is read.'
+    ),
+)
 @relationships.doc(tag='Relationships')
-def get_relationships(headers: AuthorizationObject):
+@fast_output(RelationshipData, many=True)
+def get_relationships(query: RelationshipListingData, headers: AuthorizationObject):
     me = authorize(headers['authorization'])
-    relationships: list[Relationship] = Relationship.objects(
-        Relationship.user_id == me.id
-    ).all()
+    after = decode_cursor(query['after']) if 'after' in query else None
 
-    return [
-        easily_productionify_relationship(relationship=pr)
-        for pr in relationships
+    if query['stream']:
+        return stream_relationships(me.id, after)
+
+    if 'limit' not in query and after is None:
+        return productionify_page(fetch_relationships(me.id))
+
+    page, state = read_page(
+        fetch_relationships_page_async(
+            me.id, query.get('limit', USER_BATCH_SIZE), after
+        )
+    )
+    headers = {'X-Next-Cursor': encode_cursor(state)} if state else {}
+
+    return productionify_page(page), headers
+
+
+@relationships.post('/users/@me/relationships/bulk')
+@limiter.limit('5/second')
+@relationships.input(BulkRelationships)
+@relationships.input(Authorization, 'headers')
+@relationships.output(
+    BulkResult(many=True),
+    description=(
+        'What happened to each operation, in order. `status` is what the '
+        'matching PATCH or DELETE would have answered.'
+    ),
+)
+@relationships.doc(tag='Relationships')
+@fast_output(BulkResult, many=True)
+def bulk_relationships(json: BulkRelationshipsData, headers: AuthorizationObject):
+    peer = authorize(headers['authorization'])
+    operations = json['operations']
+    target_ids = list(dict.fromkeys(op['user_id'] for op in operations))
+    removing = {op['user_id'] for op in operations if op['action'] == 'remove'}
+
+    # every read is sent before any is waited on, the peer's rows are one
+    # partition and come back in a single query
+    pending_rows = fetch_relationships_with_async(peer.id, target_ids)
+    pending_reverse = {
+        target_id: fetch_relationship_async(target_id, peer.id)
+        for target_id in target_ids
+        if target_id in removing
+    }
+    targets = get_users(target_ids)
+    rows = {row.target_id: row for row in pending_rows.result()}
+
+    results: list[dict[str, Any]] = []
+    accepted: list[int] = []
+    removed: list[int] = []
+    seen: set[int] = set()
+
+    for op in operations:
+        user_id, action = op['user_id'], op['action']
+        result: dict[str, Any] = {
+            'user_id': user_id,
+            'action': action,
+            'status': 204,
+            'message': None,
+        }
+        results.append(result)
+
+        if user_id in seen:
+            result.update(status=400, message='Duplicate operation for this user')
+            continue
+
+        seen.add(user_id)
+        row = rows.get(user_id)
+
+        if user_id not in targets:
+            status = 400 if action == 'accept' else 404
+            result.update(status=status, message='Target user does not exist')
+        elif row is None:
+            result.update(
+                status=400, message='You do not have a relationship with this user'
+            )
+        elif action == 'remove':
+            removed.append(user_id)
+        elif row.type == Relation.INCOMING:
+            accepted.append(user_id)
+        else:
+            result.update(
+                status=400, message='You cannot modify this type of relationship'
+            )
+
+    # one statement per target partition, all in flight at once
+    writes = [
+        insert_relationship_async(target_id, peer.id, Relation.FRIEND)
+        for target_id in accepted
     ]
+    deleted = [peer.id] * len(removed)
+
+    for target_id in removed:
+        reverse = pending_reverse[target_id].result()
+
+        # blocked users
+        if reverse is not None and reverse.type != Relation.BLOCKED:
+            writes.append(delete_relationship_async(target_id, peer.id))
+            deleted.append(target_id)
+
+    # and the peer's side as a single mutation
+    with BatchQuery(batch_type=BatchType.Unlogged) as batch:
+        for target_id in accepted:
+            Relationship.batch(batch).create(
+                user_id=peer.id, target_id=target_id, type=Relation.FRIEND
+            )
+
+        for target_id in removed:
+            Relationship.objects(user_id=peer.id, target_id=target_id).batch(
+                batch
+            ).delete()
+
+    for write in writes:
+        write.result()
+
+    relationships_deleted(deleted)
+
+    return results
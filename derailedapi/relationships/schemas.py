@@ -20,8 +20,9 @@ from typing import TYPE_CHECKING, TypedDict
 
 from apiflask import Schema
 from apiflask.fields import Boolean, Integer, List, Nested, String
-from apiflask.validators import Length, OneOf, Regexp
+from apiflask.validators import Length, OneOf, Range, Regexp
 
+from ..fields import Snowflake
 from ..users.schemas import PublicUserObject, discriminatoregex
 
 if TYPE_CHECKING:
@@ -52,3 +53,50 @@ class MakeRelationshipData(TypedDict):
 class Relationship(Schema):
     type: int = Integer()
     user: PublicUserObject = Nested(PublicUserObject)
+
+
+class RelationshipListing(Schema):
+    limit: int = Integer(validate=Range(1, 1000))
+    after: str = String(validate=Length(1, 512))
+    stream: bool = Boolean(load_default=False)
+
+
+class RelationshipListingData(TypedDict):
+    limit: NotRequired[int]
+    after: NotRequired[str]
+    stream: bool
+
+
+# how many users one bulk request may act on
+MAX_BULK_OPERATIONS = 100
+
+
+class BulkOperation(Schema):
+    user_id: int = Integer(required=True)
+    action: str = String(required=True, validate=OneOf(['accept', 'remove']))
+
+
+class BulkOperationData(TypedDict):
+    user_id: int
+    action: str
+
+
+class BulkRelationships(Schema):
+    operations: list[BulkOperationData] = List(
+        Nested(BulkOperation),
+        required=True,
+        validate=Length(1, MAX_BULK_OPERATIONS),
+    )
+
+
+class BulkRelationshipsData(TypedDict):
+    operations: list[BulkOperationData]
+
+
+class BulkResult(Schema):
+    user_id: int = Snowflake()
+    action: str = String()
+    # what the single-user endpoint would have answered
+    status: int = Integer()
+    # why it failed, null when it did not
+    message: str | None = String(allow_none=True)
@@ -0,0 +1,320 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Hot-path queries, prepared once per session.
+#
+# cqlengine builds and sends every query as a fresh statement, prepared
+# statements skip the server-side parse and let the driver route each
+# request straight to a replica owning the partition.
+import threading
+from typing import Any, Callable, Generic, NamedTuple, Sequence, Type, TypeVar
+
+from cassandra.cluster import (
+    EXEC_PROFILE_DEFAULT,
+    ExecutionProfile,
+    ResponseFuture,
+    Session,
+)
+from cassandra.cqlengine import connection, models
+from cassandra.query import PreparedStatement, tuple_factory
+
+from .database import Credential, Relationship, RelationshipCount, Settings, User
+
+M = TypeVar('M', bound=models.Model)
+T = TypeVar('T')
+R = TypeVar('R', bound=tuple)
+
+
+# slim records for the columns each use actually needs, cheaper to
+# fetch and build than models, and unable to leak what they never read.
+class AuthUser(NamedTuple):
+    id: int
+    password: str
+    token_generation: int | None
+
+
+class PublicUser(NamedTuple):
+    id: int
+    username: str
+    discriminator: str
+    avatar: str
+    banner: str
+    flags: int
+    bot: bool
+
+
+class SelfUser(NamedTuple):
+    id: int
+    username: str
+    discriminator: str
+    avatar: str
+    banner: str
+    flags: int
+    bot: bool
+    email: str
+    verified: bool | None
+
+
+def _columns(model: Type[models.Model]) -> tuple[str, ...]:
+    return tuple(c.db_field_name for c in model._columns.values())
+
+
+def _select(
+    model: Type[models.Model], where: str, fields: Sequence[str] | None = None
+) -> tuple[Type[models.Model], str, Sequence[str] | None]:
+    return model, f'SELECT {{columns}} FROM {{table}} WHERE {where}', fields
+
+
+# the keyspace is only known after `connect()`, so tables and columns
+# get filled in when each statement is prepared.
+QUERIES: dict[str, tuple[Type[models.Model], str, Sequence[str] | None]] = {
+    'auth_user_by_id': _select(User, '"id" = ?', AuthUser._fields),
+    'public_user_by_id': _select(User, '"id" = ?', PublicUser._fields),
+    'public_users_by_ids': _select(User, '"id" IN ?', PublicUser._fields),
+    'self_user_by_id': _select(User, '"id" = ?', SelfUser._fields),
+    'settings_by_user': _select(Settings, '"user_id" = ?'),
+    'credential_by_email': _select(Credential, '"email" = ?'),
+    'relationship_by_pair': _select(Relationship, '"user_id" = ? AND "target_id" = ?'),
+    'relationships_by_user': _select(Relationship, '"user_id" = ?'),
+    'relationships_by_targets': _select(
+        Relationship, '"user_id" = ? AND "target_id" IN ?'
+    ),
+    'relationship_count': _select(RelationshipCount, '"user_id" = ?'),
+    'insert_relationship': (
+        Relationship,
+        'INSERT INTO {table} ("user_id", "target_id", "type") VALUES (?, ?, ?)',
+        None,
+    ),
+    'delete_relationship': (
+        Relationship,
+        'DELETE FROM {table} WHERE "user_id" = ? AND "target_id" = ?',
+        None,
+    ),
+    'adjust_relationship_count': (
+        RelationshipCount,
+        'UPDATE {table} SET "count" = "count" + ? WHERE "user_id" = ?',
+        None,
+    ),
+}
+
+
+def render(name: str) -> str:
+    model, query, fields = QUERIES[name]
+    columns = ', '.join(f'"{f}"' for f in fields or _columns(model))
+    return query.format(columns=columns, table=model.column_family_name())
+
+
+_prepared: dict[str, PreparedStatement] = {}
+_prepared_for: Session | None = None
+_tuple_profile: ExecutionProfile | None = None
+_lock = threading.Lock()
+
+
+def prepared(name: str) -> PreparedStatement:
+    global _prepared_for, _tuple_profile
+
+    session = connection.get_session()
+
+    with _lock:
+        if session is not _prepared_for:
+            # a new session, e.g. after a fork, needs its own statements
+            _prepared.clear()
+            _prepared_for = session
+            _tuple_profile = session.execution_profile_clone_update(
+                EXEC_PROFILE_DEFAULT, row_factory=tuple_factory
+            )
+
+        statement = _prepared.get(name)
+
+        if statement is None:
+            statement = _prepared[name] = session.prepare(render(name))
+
+    return statement
+
+
+class Deferred(Generic[T]):
+    """A statement in flight, ``result()`` waits for it and converts its rows."""
+
+    __slots__ = ('_future', '_convert')
+
+    def __init__(self, future: ResponseFuture, convert: Callable[[Any], T]) -> None:
+        self._future = future
+        self._convert = convert
+
+    def result(self) -> T:
+        return self._convert(self._future.result())
+
+
+def execute(name: str, params: Sequence[Any]) -> Any:
+    return connection.get_session().execute(prepared(name), params)
+
+
+def execute_async(
+    name: str, params: Sequence[Any], tuples: bool = False
+) -> ResponseFuture:
+    statement = prepared(name)
+    profile = _tuple_profile if tuples else EXEC_PROFILE_DEFAULT
+
+    return connection.get_session().execute_async(
+        statement, params, execution_profile=profile
+    )
+
+
+def _project_async(
+    record: Type[R], name: str, params: Sequence[Any]
+) -> Deferred[list[R]]:
+    return Deferred(
+        execute_async(name, params, tuples=True),
+        lambda rows: [record._make(row) for row in rows],
+    )
+
+
+def _project_one(record: Type[R], name: str, params: Sequence[Any]) -> R | None:
+    rows = _project_async(record, name, params).result()
+    return rows[0] if rows else None
+
+
+def fetch_auth_user(user_id: int) -> AuthUser | None:
+    """Get what verifying a token needs about a user."""
+    return _project_one(AuthUser, 'auth_user_by_id', (user_id,))
+
+
+def fetch_public_user(user_id: int) -> PublicUser | None:
+    return _project_one(PublicUser, 'public_user_by_id', (user_id,))
+
+
+def fetch_public_users_async(user_ids: list[int]) -> Deferred[list[PublicUser]]:
+    return _project_async(PublicUser, 'public_users_by_ids', (user_ids,))
+
+
+def fetch_self_user(user_id: int) -> SelfUser | None:
+    return _project_one(SelfUser, 'self_user_by_id', (user_id,))
+
+
+def _one_async(model: Type[M], name: str, params: Sequence[Any]) -> Deferred[M | None]:
+    def convert(rows: Any) -> M | None:
+        row = rows.one()
+        return None if row is None else model._construct_instance(row)
+
+    return Deferred(execute_async(name, params), convert)
+
+
+def _one(model: Type[M], name: str, params: Sequence[Any]) -> M | None:
+    return _one_async(model, name, params).result()
+
+
+def _all(model: Type[M], name: str, params: Sequence[Any]) -> list[M]:
+    return [model._construct_instance(row) for row in execute(name, params)]
+
+
+def fetch_settings_async(user_id: int) -> Deferred[Settings | None]:
+    return _one_async(Settings, 'settings_by_user', (user_id,))
+
+
+def fetch_settings(user_id: int) -> Settings | None:
+    return fetch_settings_async(user_id).result()
+
+
+def fetch_credential(email: str) -> Credential | None:
+    return _one(Credential, 'credential_by_email', (email,))
+
+
+def fetch_relationship_async(
+    user_id: int, target_id: int
+) -> Deferred[Relationship | None]:
+    return _one_async(Relationship, 'relationship_by_pair', (user_id, target_id))
+
+
+def fetch_relationship(user_id: int, target_id: int) -> Relationship | None:
+    return fetch_relationship_async(user_id, target_id).result()
+
+
+def fetch_relationships(user_id: int) -> list[Relationship]:
+    return _all(Relationship, 'relationships_by_user', (user_id,))
+
+
+def execute_page(
+    name: str, params: Sequence[Any], fetch_size: int, paging_state: bytes | None
+) -> ResponseFuture:
+    """Fetch one page of ``fetch_size`` rows, continuing from ``paging_state``."""
+    statement = prepared(name).bind(params)
+    statement.fetch_size = fetch_size
+
+    return connection.get_session().execute_async(statement, paging_state=paging_state)
+
+
+def fetch_relationships_page_async(
+    user_id: int, limit: int, paging_state: bytes | None = None
+) -> Deferred[tuple[list[Relationship], bytes | None]]:
+    """A page of ``user_id``'s relationships and the state to get the next one."""
+
+    def convert(rows: Any) -> tuple[list[Relationship], bytes | None]:
+        # `current_rows`, iterating the result set would fetch every page
+        page = [Relationship._construct_instance(row) for row in rows.current_rows]
+        return page, rows.paging_state
+
+    return Deferred(
+        execute_page('relationships_by_user', (user_id,), limit, paging_state),
+        convert,
+    )
+
+
+def fetch_relationship_count_async(user_id: int) -> Deferred[int]:
+    def convert(rows: Any) -> int:
+        row = rows.one()
+        return 0 if row is None else row['count'] or 0
+
+    return Deferred(execute_async('relationship_count', (user_id,)), convert)
+
+
+def fetch_relationship_count(user_id: int) -> int:
+    return fetch_relationship_count_async(user_id).result()
+
+
+def insert_relationship_async(
+    user_id: int, target_id: int, type: int
+) -> Deferred[None]:
+    return Deferred(
+        execute_async('insert_relationship', (user_id, target_id, type)),
+        lambda rows: None,
+    )
+
+
+def insert_relationship(user_id: int, target_id: int, type: int) -> None:
+    insert_relationship_async(user_id, target_id, type).result()
+
+
+def fetch_relationships_with_async(
+    user_id: int, target_ids: list[int]
+) -> Deferred[list[Relationship]]:
+    """``user_id``'s relationships with any of ``target_ids``, in one read."""
+    return Deferred(
+        execute_async('relationships_by_targets', (user_id, target_ids)),
+        lambda rows: [Relationship._construct_instance(row) for row in rows],
+    )
+
+
+def delete_relationship_async(user_id: int, target_id: int) -> Deferred[None]:
+    return Deferred(
+        execute_async('delete_relationship', (user_id, target_id)),
+        lambda rows: None,
+    )
+
+
+def adjust_relationship_count_async(user_id: int, delta: int) -> Deferred[None]:
+    return Deferred(
+        execute_async('adjust_relationship_count', (delta, user_id)),
+        lambda rows: None,
+    )
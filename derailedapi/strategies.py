@@ -0,0 +1,356 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Rate limiting strategies, registered with `limits` so the Limiter can
+# pick them by name.
+import math
+import os
+import threading
+import time
+
+from limits.limits import RateLimitItem
+from limits.storage import MemoryStorage, RedisStorage, StorageTypes
+from limits.strategies import (
+    STRATEGIES,
+    FixedWindowElasticExpiryRateLimiter,
+    RateLimiter,
+)
+
+from .cache import TTLCache
+
+# the most hits a worker reserves from shared storage at once
+LOCAL_BATCH = int(os.getenv('RATELIMIT_LOCAL_BATCH') or 10)
+# keys a worker keeps leases for before dropping the oldest
+LOCAL_MAX_KEYS = int(os.getenv('RATELIMIT_LOCAL_KEYS') or 10000)
+# a reservation takes at most half its share of what is left of a limit
+LOCAL_SHARE = 2
+
+
+class _Lease:
+    __slots__ = ('tokens', 'shared', 'size', 'contenders', 'expires_at')
+
+    def __init__(self) -> None:
+        self.tokens = 0
+        # the shared count after this worker's last reservation
+        self.shared = 0
+        # how many hits that reservation asked for
+        self.size = 0
+        # reservations other workers made for every one of this worker's,
+        # unknown until it reserved twice
+        self.contenders: int | None = None
+        self.expires_at = 0.0
+
+
+class LocalTierRateLimiter(FixedWindowElasticExpiryRateLimiter):
+    """``fixed-window-elastic-expiry`` with a per-worker token bucket in front.
+
+    Instead of one storage increment per hit a worker reserves a batch of
+    hits from the shared counter and spends it in memory. A worker reserves
+    only the hit it is making until it has reserved twice, and so learned
+    how many reservations other workers make in between. Every later batch
+    doubles the last one, up to a tenth of the limit and at most
+    ``RATELIMIT_LOCAL_BATCH``, but never more than half of this worker's
+    share of what is left once the others reserved as much again. Limits
+    under 20 hits per window reserve one hit at a time, exactly like
+    before.
+
+    Hits are reserved before they are admitted and a lease expires with the
+    window it was taken from, so a key is never admitted more than its
+    limit per window: the over-admission bound is zero. In exchange a key
+    may be rejected early by hits other workers reserved and have not spent
+    yet. Those shrink with what is left and with how many workers share
+    the key, a client spread over every worker of a box falls back to one
+    reservation per hit. Hits spent from a lease do not extend the elastic
+    window, only reservations (and so every rejection) do.
+    """
+
+    def __init__(self, storage: StorageTypes) -> None:
+        super().__init__(storage)
+        self._leases: dict[str, _Lease] = {}
+        self._lock = threading.Lock()
+
+        if hasattr(os, 'register_at_fork'):
+            # leases inherited over a fork would be spent twice
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def _live_lease(self, key: str, now: float) -> _Lease | None:
+        lease = self._leases.get(key)
+
+        if lease is not None and lease.expires_at <= now:
+            del self._leases[key]
+            return None
+
+        return lease
+
+    def _batch_size(self, item: RateLimitItem, lease: _Lease | None, cost: int) -> int:
+        if lease is None or lease.contenders is None:
+            return cost
+
+        # the others have likely reserved as much again since
+        left = item.amount - lease.shared - lease.contenders * lease.size
+        share = left // (LOCAL_SHARE * (lease.contenders + 1))
+        size = min(LOCAL_BATCH, item.amount // 10, lease.size * 2, share)
+        return max(cost, size)
+
+    def _prune(self, now: float) -> None:
+        for key in [k for k, v in self._leases.items() if v.expires_at <= now]:
+            del self._leases[key]
+
+        while len(self._leases) > LOCAL_MAX_KEYS:
+            del self._leases[next(iter(self._leases))]
+
+    def hit(self, item: RateLimitItem, *identifiers: str, cost: int = 1) -> bool:
+        key = item.key_for(*identifiers)
+        now = time.time()
+
+        with self._lock:
+            lease = self._live_lease(key, now)
+
+            if lease is not None and lease.tokens >= cost:
+                lease.tokens -= cost
+                return True
+
+            size = self._batch_size(item, lease, cost)
+
+        # storage is not called under the lock, other keys keep flowing
+        count = self.storage.incr(
+            key, item.get_expiry(), elastic_expiry=True, amount=size
+        )
+        granted = min(size, max(0, item.amount - (count - size)))
+
+        with self._lock:
+            lease = self._leases.get(key)
+
+            if lease is None:
+                lease = self._leases[key] = _Lease()
+
+                if len(self._leases) > LOCAL_MAX_KEYS:
+                    self._prune(now)
+            else:
+                others = count - size - lease.shared
+                lease.contenders = max(0, others) // lease.size
+
+            lease.tokens += granted
+            lease.shared = count
+            lease.size = size
+            lease.expires_at = now + item.get_expiry()
+
+            if lease.tokens >= cost:
+                lease.tokens -= cost
+                return True
+
+        return False
+
+    def test(self, item: RateLimitItem, *identifiers: str) -> bool:
+        with self._lock:
+            lease = self._live_lease(item.key_for(*identifiers), time.time())
+
+            if lease is not None and lease.tokens > 0:
+                return True
+
+        return super().test(item, *identifiers)
+
+    def get_window_stats(
+        self, item: RateLimitItem, *identifiers: str
+    ) -> tuple[int, int]:
+        # answered from the lease, the headers should not cost a round trip
+        with self._lock:
+            lease = self._live_lease(item.key_for(*identifiers), time.time())
+
+            if lease is not None:
+                remaining = max(0, item.amount - lease.shared) + lease.tokens
+                return math.ceil(lease.expires_at), remaining
+
+        return super().get_window_stats(item, *identifiers)
+
+    def clear(self, item: RateLimitItem, *identifiers: str) -> None:
+        with self._lock:
+            self._leases.pop(item.key_for(*identifiers), None)
+
+        super().clear(item, *identifiers)
+
+
+STRATEGIES['local-fixed-window-elastic-expiry'] = LocalTierRateLimiter
+
+
+# decides a hit with the server's clock, so every worker agrees on `now`.
+# Lua numbers are truncated when returned to redis, hence the strings.
+GCRA_SCRIPT = """
+-- effects replication is the default since redis 5 and this is deprecated
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + clock[2] / 1000
+local interval = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+
+if tat < now then
+    tat = now
+end
+
+local new_tat = tat + interval * cost
+
+if new_tat - period > now then
+    return {0, tostring(tat), tostring(now)}
+end
+
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil(new_tat - now))
+return {1, tostring(new_tat), tostring(now)}
+"""
+
+
+def gcra(
+    tat: float | None, now: float, interval: float, period: float, cost: int
+) -> tuple[bool, float]:
+    """Decide a hit, the same way ``GCRA_SCRIPT`` does.
+
+    Returns whether the hit is allowed and the theoretical arrival time
+    (TAT) to store, which is left unchanged when it is not.
+    """
+    tat = max(tat or now, now)
+    new_tat = tat + interval * cost
+
+    if new_tat - period > now:
+        return False, tat
+
+    return True, new_tat
+
+
+class GCRARateLimiter(RateLimiter):
+    """Generic cell rate algorithm, a key is one timestamp.
+
+    Hits are spaced ``period / amount`` apart, with bursts of up to
+    ``amount`` hits. Unlike the fixed windows there is no boundary at
+    which a second burst is allowed straight after the first. Each hit is
+    one atomic storage operation, a script on redis and a locked update in
+    memory.
+
+    ``X-RateLimit-Reset`` is when the next hit is allowed once a key is
+    exhausted, and when it is fully replenished otherwise.
+    """
+
+    def __init__(self, storage: StorageTypes) -> None:
+        if not isinstance(storage, (RedisStorage, MemoryStorage)):
+            raise NotImplementedError(
+                f'GCRA is not implemented for storage of type {type(storage)}'
+            )
+
+        super().__init__(storage)
+        self._script = None
+        self._tats: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        # what this worker saw last, so the headers do not cost a round trip
+        self._seen = TTLCache(maxsize=LOCAL_MAX_KEYS, ttl=1)
+
+        if isinstance(storage, RedisStorage):
+            self._script = storage.storage.register_script(GCRA_SCRIPT)
+
+    @staticmethod
+    def _key(item: RateLimitItem, identifiers: tuple[str, ...]) -> str:
+        # a counter from another strategy must not be read as a timestamp
+        return 'gcra/' + item.key_for(*identifiers)
+
+    @staticmethod
+    def _shape(item: RateLimitItem) -> tuple[float, float]:
+        period = item.get_expiry() * 1000
+        return period / item.amount, period
+
+    def _memory_hit(self, key: str, interval: float, period: float, cost: int):
+        now = time.time() * 1000
+
+        with self._lock:
+            tat, expires_at = self._tats.get(key, (None, 0))
+
+            if expires_at <= now:
+                tat = None
+
+            allowed, tat = gcra(tat, now, interval, period, cost)
+
+            if allowed:
+                self._tats[key] = (tat, tat)
+
+                if len(self._tats) > LOCAL_MAX_KEYS:
+                    for k in [k for k, v in self._tats.items() if v[1] <= now]:
+                        del self._tats[k]
+
+        return allowed, tat, now
+
+    def _read(self, key: str) -> tuple[float | None, float]:
+        seen = self._seen.get(key)
+
+        if seen is not None:
+            return seen, time.time() * 1000
+
+        if self._script is not None:
+            raw = self.storage.storage.get(key)
+            return (float(raw) if raw is not None else None), time.time() * 1000
+
+        now = time.time() * 1000
+
+        with self._lock:
+            tat, expires_at = self._tats.get(key, (None, 0))
+
+        return (tat if expires_at > now else None), now
+
+    def hit(self, item: RateLimitItem, *identifiers: str, cost: int = 1) -> bool:
+        key = self._key(item, identifiers)
+        interval, period = self._shape(item)
+
+        if self._script is not None:
+            allowed, tat, now = self._script([key], [interval, period, cost])
+            allowed, tat = bool(int(allowed)), float(tat)
+        else:
+            allowed, tat, _ = self._memory_hit(key, interval, period, cost)
+
+        self._seen.set(key, tat)
+        return allowed
+
+    def test(self, item: RateLimitItem, *identifiers: str) -> bool:
+        interval, period = self._shape(item)
+        tat, now = self._read(self._key(item, identifiers))
+        return gcra(tat, now, interval, period, 1)[0]
+
+    def get_window_stats(
+        self, item: RateLimitItem, *identifiers: str
+    ) -> tuple[int, int]:
+        interval, period = self._shape(item)
+        tat, now = self._read(self._key(item, identifiers))
+        tat = max(tat or now, now)
+        remaining = min(item.amount, int((period - (tat - now)) // interval))
+
+        if remaining > 0:
+            return math.ceil(tat / 1000), remaining
+
+        return math.ceil((tat - period + interval) / 1000), 0
+
+    def clear(self, item: RateLimitItem, *identifiers: str) -> None:
+        key = self._key(item, identifiers)
+        self._seen.pop(key)
+
+        with self._lock:
+            self._tats.pop(key, None)
+
+        self.storage.clear(key)
+
+
+STRATEGIES['gcra'] = GCRARateLimiter
@@ -0,0 +1,127 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import random
+
+from cassandra.cqlengine.query import LWTException
+
+from ..database import DiscriminatorAllocation, User
+
+# discriminators go from 0001 to 9999, bit 0 is never used
+SLOTS = 10000
+# how many times a claim is retried when another writer got in first
+MAX_ATTEMPTS = 10
+
+
+def _is_taken(slots: bytearray, number: int) -> bool:
+    return bool(slots[number >> 3] & (1 << (number & 7)))
+
+
+def _mark(slots: bytearray, number: int, taken: bool) -> None:
+    if taken:
+        slots[number >> 3] |= 1 << (number & 7)
+    else:
+        slots[number >> 3] &= ~(1 << (number & 7)) & 0xFF
+
+
+def _seed(username: str) -> tuple[bytearray, int]:
+    # built once per username from the users which registered before
+    # allocations were tracked.
+    slots = bytearray(SLOTS // 8)
+
+    for user in (
+        User.objects(User.username == username).only(['discriminator']).limit(None)
+    ):
+        _mark(slots, int(user.discriminator), True)
+
+    try:
+        DiscriminatorAllocation.if_not_exists().create(
+            username=username, slots=bytes(slots), version=0
+        )
+    except LWTException:
+        return _load(username)
+
+    return slots, 0
+
+
+def _load(username: str) -> tuple[bytearray, int]:
+    try:
+        allocation: DiscriminatorAllocation = DiscriminatorAllocation.objects(
+            DiscriminatorAllocation.username == username
+        ).get()
+    except DiscriminatorAllocation.DoesNotExist:
+        return _seed(username)
+
+    return bytearray(allocation.slots), allocation.version
+
+
+def _store(username: str, slots: bytearray, version: int) -> bool:
+    try:
+        DiscriminatorAllocation.objects(
+            DiscriminatorAllocation.username == username
+        ).iff(version=version).update(slots=bytes(slots), version=version + 1)
+    except LWTException:
+        return False
+
+    return True
+
+
+def _pick_free(slots: bytearray) -> int | None:
+    start = random.randint(1, SLOTS - 1)
+
+    for offset in range(SLOTS - 1):
+        number = (start + offset - 1) % (SLOTS - 1) + 1
+
+        if not _is_taken(slots, number):
+            return number
+
+    return None
+
+
+def claim_discriminator(username: str, discriminator: str | None = None) -> str | None:
+    """Atomically reserve ``discriminator``, or a random free one, for ``username``.
+
+    Returns the reserved discriminator, or None when it is taken or
+    the username has no free discriminators left.
+    """
+    for _ in range(MAX_ATTEMPTS):
+        slots, version = _load(username)
+
+        if discriminator is None:
+            number = _pick_free(slots)
+
+            if number is None:
+                return None
+        else:
+            number = int(discriminator)
+
+            if not 0 < number < SLOTS or _is_taken(slots, number):
+                return None
+
+        _mark(slots, number, True)
+
+        if _store(username, slots, version):
+            return '%04d' % number
+
+    return None
+
+
+def release_discriminator(username: str, discriminator: str) -> None:
+    for _ in range(MAX_ATTEMPTS):
+        slots, version = _load(username)
+        _mark(slots, int(discriminator), False)
+
+        if _store(username, slots, version):
+            return
@@ -0,0 +1,78 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Gives every user created before `credentials` existed their row, so
+# logins and registrations only ever read `credentials`.
+#
+# Rows are created with IF NOT EXISTS, a credential the API wrote or
+# changed in the meantime always wins. Running it again only fills in
+# what is still missing.
+import sys
+
+from cassandra.cqlengine.query import LWTException
+
+from ..database import Credential, Settings, User
+from ..statements import Deferred, fetch_settings_async
+
+# users whose settings are read at once
+BATCH_SIZE = 100
+
+
+def _copy(pending: list[tuple[User, Deferred[Settings | None]]]) -> int:
+    created = 0
+
+    for user, pending_setting in pending:
+        setting = pending_setting.result()
+
+        try:
+            Credential.if_not_exists().create(
+                email=user.email,
+                user_id=user.id,
+                password=user.password,
+                token_generation=user.token_generation,
+                mfa_enabled=bool(setting and setting.mfa_enabled),
+                mfa_code=setting.mfa_code if setting else None,
+            )
+        except LWTException:
+            continue
+
+        created += 1
+
+    return created
+
+
+def backfill() -> int:
+    users = (
+        User.objects.all()
+        .only(['id', 'email', 'password', 'token_generation'])
+        .limit(None)
+    )
+    pending: list[tuple[User, Deferred[Settings | None]]] = []
+    seen = created = 0
+
+    for user in users:
+        if not user.email:
+            continue
+
+        pending.append((user, fetch_settings_async(user.id)))
+
+        if len(pending) == BATCH_SIZE:
+            created += _copy(pending)
+            seen += len(pending)
+            pending = []
+            print(f'{seen} users: {created} credentials created', file=sys.stderr)
+
+    created += _copy(pending)
+    return created
@@ -13,15 +13,29 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-import random
 import secrets
+from typing import Callable
 
 import pyotp
 from apiflask import APIBlueprint, HTTPError
-from argon2 import PasswordHasher, exceptions
-
-from ..database import RecoveryCode, Settings, User, create_token, verify_token
+from argon2 import exceptions
+from cassandra.cqlengine.query import LWTException
+
+from ..database import (
+    Credential,
+    RecoveryCode,
+    Settings,
+    User,
+    create_token,
+    invalidate_user,
+    verify_token,
+)
+from ..enforgement import forger
+from ..hashing import hash_password, verify_password
 from ..ratelimiter import limiter
+from ..serializers import fast_output
+from ..statements import AuthUser, SelfUser, fetch_credential, fetch_self_user
+from .discriminators import claim_discriminator, release_discriminator
 from .schemas import (
     Authorization,
     AuthorizationObject,
@@ -37,25 +51,12 @@ from .schemas import (
 
 users = APIBlueprint('users', __name__)
 registerr = APIBlueprint('register', 'derailedapi.register')
-hasher = PasswordHasher()
 
 
 def new_code() -> str:
     return secrets.token_hex(70)
 
 
-def is_too_used(username: str):
-    used: int = User.objects(User.username == username).count()
-
-    if used > 9000:
-        raise HTTPError(400, 'Too many people are using this username.')
-
-
-def roll_discriminator() -> str:
-    discriminator_number = random.randint(1, 9999)
-    return '%04d' % discriminator_number
-
-
 def get_recoveries(user_id: int) -> list[str]:
     codes: list[RecoveryCode] = RecoveryCode.objects(
         RecoveryCode.user_id == user_id
@@ -63,56 +64,79 @@ def get_recoveries(user_id: int) -> list[str]:
     return [c.code for c in codes]
 
 
-def get_available_discriminator(username: str):
-    is_too_used(username=username)
+def get_available_discriminator(username: str) -> str | None:
+    return claim_discriminator(username=username)
 
-    for _ in range(10):
-        discriminator = roll_discriminator()
 
-        try:
-            User.objects(
-                User.username == username, User.discriminator == discriminator
-            ).get()
-        except:
-            return discriminator
-        else:
-            continue
+def authorize(token: str) -> AuthUser:
+    return verify_token(token=token)
+
 
-    return None
+def get_credential(email: str) -> Credential | None:
+    # every user has one since the `credentials` backfill migration
+    return fetch_credential(email)
 
 
-def is_available(username: str, discriminator: int):
+def update_credential(
+    user: AuthUser, profile: SelfUser, query: dict
+) -> Callable[[], None]:
+    """Mirror an edit of ``user``'s email or password onto their credential.
+
+    Returns a function putting the credential back the way it was, for
+    when updating the user itself fails.
+    """
+    credential = get_credential(email=profile.email)
+    email = query.get('email', profile.email)
+    fields = {
+        'user_id': user.id,
+        'password': query.get('password', user.password),
+        'token_generation': query.get('token_generation', user.token_generation),
+        'mfa_enabled': credential.mfa_enabled if credential else False,
+        'mfa_code': credential.mfa_code if credential else None,
+    }
+    previous = (
+        {name: getattr(credential, name) for name in fields}
+        if credential is not None
+        else None
+    )
+
+    if credential is not None and email == credential.email:
+        credential.update(**fields)
+        return lambda: credential.update(**previous)
+
+    if get_credential(email=email) is not None:
+        raise HTTPError(400, 'This email is already used.')
+
     try:
-        User.objects(
-            User.username == username, User.discriminator == discriminator
-        ).get()
-    except:
-        return
-    else:
-        raise HTTPError(400, 'Discriminator is already taken')
+        Credential.if_not_exists().create(email=email, **fields)
+    except LWTException:
+        raise HTTPError(400, 'This email is already used.')
 
+    if credential is not None:
+        credential.delete()
 
-def authorize(token: str) -> User:
-    return verify_token(token=token)
+    def undo() -> None:
+        if previous is not None:
+            Credential.create(email=profile.email, **previous)
 
+        Credential.objects(Credential.email == email).delete()
+
+    return undo
 
-def verify_mfa(user_id: int, code: int | str | None) -> None:
-    setting: Settings = (
-        Settings.objects(Settings.user_id == user_id)
-        .only(['mfa_enabled', 'mfa_code'])
-        .get()
-    )
 
-    recoveries = get_recoveries(user_id=user_id)
+def verify_mfa(credential: Credential, code: int | str | None) -> None:
+    if not credential.mfa_enabled:
+        return
 
-    if setting.mfa_enabled:
-        totp = pyotp.TOTP(setting.mfa_code)
+    if not code:
+        raise HTTPError(403, 'mfa_code is a required field for users with mfa.')
 
-        if not code:
-            raise HTTPError(403, 'mfa_code is a required field for users with mfa.')
+    if code == pyotp.TOTP(credential.mfa_code).now():
+        return
 
-        if code not in recoveries or code != totp.now():
-            raise HTTPError(403, 'mfa code is invalid.')
+    # recovery codes are only needed once the totp check failed
+    if code not in get_recoveries(user_id=credential.user_id):
+        raise HTTPError(403, 'mfa code is invalid.')
 
 
 @registerr.post('/register')
@@ -123,11 +147,7 @@ def verify_mfa(user_id: int, code: int | str | None) -> None:
 )
 @registerr.doc(tag='Users')
 def register(json: CreateUserObject):
-    try:
-        User.objects(User.email == json['email']).get()
-    except:
-        pass
-    else:
+    if get_credential(email=json['email']) is not None:
         raise HTTPError(400, 'This email is already used.')
 
     discriminator = get_available_discriminator(username=json['username'])
@@ -135,32 +155,62 @@ def register(json: CreateUserObject):
     if discriminator is None:
         raise HTTPError(400, 'Too many people are using this username.')
 
-    password = hasher.hash(json['password'])
+    # until the user exists, a failure must give the discriminator back
+    try:
+        password = hash_password(json['password'])
+        user_id = forger.forge()
+
+        try:
+            Credential.if_not_exists().create(
+                email=json['email'], user_id=user_id, password=password
+            )
+        except LWTException:
+            raise HTTPError(400, 'This email is already used.')
+
+        try:
+            user: User = User.create(
+                id=user_id,
+                username=json['username'],
+                email=json['email'],
+                password=password,
+                discriminator=discriminator,
+            )
+        except BaseException:
+            # or the email could never register again
+            Credential.objects(Credential.email == json['email']).delete()
+            raise
+    except BaseException:
+        release_discriminator(username=json['username'], discriminator=discriminator)
+        raise
 
-    user: User = User.create(
-        username=json['username'],
-        email=json['email'],
-        password=password,
-        discriminator=discriminator,
-    )
     Settings.create(user_id=user.id)
 
-    return {'token': create_token(user_id=user.id, user_password=user.password)}
+    return {
+        'token': create_token(
+            user_id=user.id,
+            user_password=user.password,
+            token_generation=user.token_generation,
+        )
+    }
 
 
 @users.get('/users/@me')
 @users.input(Authorization, 'headers')
 @users.output(UserObject)
 @users.doc(tag='Users')
+@fast_output(UserObject)
 def get_me(headers: AuthorizationObject):
     me = authorize(headers['authorization'])
+    profile = fetch_self_user(me.id)
+
+    if profile is None:
+        raise HTTPError(401, 'Object for Authorization not found')
 
-    if me.verified is None:
-        me = me.update(verified=False)
+    if profile.verified is None:
+        User.objects(User.id == me.id).update(verified=False)
+        profile = profile._replace(verified=False)
 
-    u = dict(me)
-    u.pop('password')
-    return u
+    return profile._asdict()
 
 
 @users.post('/login')
@@ -168,22 +218,24 @@ def get_me(headers: AuthorizationObject):
 @users.output(Register)
 @users.doc(tag='Users')
 def login(json: CreateTokenObject):
-    try:
-        with_pswd: User = (
-            User.objects(User.email == json['email']).only(['password', 'id']).get()
-        )
-    except:
+    credential = get_credential(email=json['email'])
+
+    if credential is None:
         raise HTTPError(400, 'Invalid email or password')
 
     try:
-        hasher.verify(with_pswd.password, json['password'])
+        verify_password(credential.password, json['password'])
     except exceptions.VerifyMismatchError:
         raise HTTPError(400, 'Invalid email or password')
 
-    verify_mfa(user_id=with_pswd.id, code=json.get('code'))
+    verify_mfa(credential=credential, code=json.get('code'))
 
     return {
-        'token': create_token(user_id=with_pswd.id, user_password=with_pswd.password)
+        'token': create_token(
+            user_id=credential.user_id,
+            user_password=credential.password,
+            token_generation=credential.token_generation,
+        )
     }
 
 
@@ -193,8 +245,13 @@ def login(json: CreateTokenObject):
 @users.input(Authorization, 'headers')
 @users.output(UserObject)
 @users.doc(tag='Users')
+@fast_output(UserObject)
 def edit_me(json: EditUserObject, headers: AuthorizationObject):
     user = authorize(headers['authorization'])
+    profile = fetch_self_user(user.id)
+
+    if profile is None:
+        raise HTTPError(401, 'Object for Authorization not found')
 
     email = json.get('email')
     discriminator = json.get('discriminator')
@@ -206,22 +263,49 @@ def edit_me(json: EditUserObject, headers: AuthorizationObject):
     if email:
         query['email'] = email
 
-    if discriminator:
-        is_available(username=user.username, discriminator=discriminator)
+    previous_tag = (profile.username, profile.discriminator)
+    new_tag = (username or profile.username, discriminator or profile.discriminator)
+
+    if new_tag != previous_tag:
+        if claim_discriminator(username=new_tag[0], discriminator=new_tag[1]) is None:
+            raise HTTPError(400, 'Discriminator is already taken')
 
+    if discriminator:
         query['discriminator'] = discriminator
 
     if username:
-        is_available(
-            username=username, discriminator=discriminator or user.discriminator
-        )
-
         query['username'] = username
 
-    if password:
-        query['password'] = hasher.hash(password=password)
+    # until the user is updated, a failure must give the new tag back and
+    # put the credential back the way it was
+    undo_credential = None
+
+    try:
+        if password:
+            query['password'] = hash_password(password)
+            # revokes every token issued before the password change
+            query['token_generation'] = (user.token_generation or 0) + 1
+
+        if 'email' in query or 'password' in query:
+            undo_credential = update_credential(user=user, profile=profile, query=query)
+
+        if query:
+            User.objects(User.id == user.id).update(**query)
+    except BaseException:
+        if new_tag != previous_tag:
+            release_discriminator(username=new_tag[0], discriminator=new_tag[1])
+
+        if undo_credential is not None:
+            undo_credential()
+
+        raise
+
+    if new_tag != previous_tag:
+        release_discriminator(username=previous_tag[0], discriminator=previous_tag[1])
+
+    if query:
+        invalidate_user(user_id=user.id)
 
-    update = user.update(**query)
-    ret = dict(update)
-    ret.pop('password')
+    ret = profile._asdict()
+    ret.update((k, v) for k, v in query.items() if k in ret)
     return ret
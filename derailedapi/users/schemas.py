@@ -25,7 +25,10 @@ from apiflask import Schema
 from apiflask.fields import Boolean, Email, Integer, String
 from apiflask.validators import Length, Regexp
 
-discriminatoregex = re.compile(r'^[0-9]{4}$')
+from ..fields import Snowflake
+
+# 0001 to 9999, 0000 is never handed out
+discriminatoregex = re.compile(r'^(?!0000)[0-9]{4}$')
 
 
 class CreateUser(Schema):
@@ -69,7 +72,7 @@ class AuthorizationObject(TypedDict):
 
 
 class PublicUserObject(Schema):
-    id: int = Integer()
+    id: int = Snowflake()
     username: str = String()
     discriminator: str = String()
     avatar: str = String()
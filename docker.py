@@ -35,5 +35,23 @@ limitations under the License.
 # https://github.com/concordchat/concord-api/blob/canary/run.py#L1-L16
 
 import os
+import shutil
 
-os.system('gunicorn -w $((`nproc` * 2 + 1)) -k gevent -b 0.0.0.0:5000 app:app')
+from derailedapi.enforgement import MAX_PROCESSES
+
+# every worker writes its metrics here, samples of a previous run would
+# be added to the new ones
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/derailed-metrics')
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir)
+
+# tables are synced once per deploy, not by every worker
+if os.system('python -m derailedapi.migrations') != 0:
+    raise SystemExit('migrations failed')
+
+# every worker needs its own snowflake process id
+workers = min(len(os.sched_getaffinity(0)) * 2 + 1, MAX_PROCESSES)
+
+os.system(
+    f'gunicorn -c gunicorn.conf.py -w {workers} -k gevent -b 0.0.0.0:5000 app:app'
+)
@@ -0,0 +1,71 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+def on_starting(server):
+    import logging
+
+    from derailedapi.enforgement import MAX_PROCESSES
+
+    # the app logs to `derailedapi.*`, which nothing else configures. It
+    # goes where and at the level gunicorn's error log does.
+    log = logging.getLogger('derailedapi')
+    log.handlers = server.log.error_log.handlers
+    log.setLevel(server.log.error_log.level)
+    log.propagate = False
+
+    if server.cfg.workers > MAX_PROCESSES:
+        raise SystemExit(
+            f'{server.cfg.workers} workers were asked for, but only '
+            f'{MAX_PROCESSES} can forge snowflakes on one box'
+        )
+
+
+def pre_fork(server, worker):
+    # snowflakes need a distinct process id per live worker, a respawned
+    # worker takes over the slot of the one it replaces
+    from derailedapi.enforgement import process_slot
+
+    taken = {getattr(w, 'snowflake_slot', None) for w in server.WORKERS.values()}
+    worker.snowflake_slot = process_slot(taken)
+
+
+def post_fork(server, worker):
+    import os
+
+    os.environ['SNOWFLAKE_PROCESS_ID'] = str(worker.snowflake_slot)
+
+    # with preload_app the forger already exists and resolved a pid-based id
+    from derailedapi.enforgement import forger
+
+    forger.refresh_process_id()
+
+
+def post_worker_init(worker):
+    # runs after gevent patched the worker, so the session uses its reactor
+    from derailedapi.database import ensure_connected
+
+    ensure_connected()
+
+
+def child_exit(server, worker):
+    # live gauges of a dead worker must stop counting towards the sums
+    import os
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,154 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# The compiled dump functions must match marshmallow's output exactly.
+import pytest
+from flask import Flask
+
+from derailedapi.channels.schemas import DMChannel, Message, UserChannel
+from derailedapi.relationships.schemas import BulkResult, Relationship
+from derailedapi.serializers import compile_schema
+from derailedapi.users.schemas import PublicUserObject, UserObject
+
+PUBLIC_USER = {
+    'id': 634334476998057984,
+    'username': 'user1',
+    'discriminator': '0042',
+    'avatar': '',
+    'banner': None,
+    'flags': 4,
+    'bot': False,
+}
+
+USERS = [
+    PUBLIC_USER,
+    {**PUBLIC_USER, 'avatar': None, 'flags': None, 'bot': None},
+    # values the driver could hand back in another type
+    {**PUBLIC_USER, 'id': '634334476998057984', 'discriminator': 42, 'bot': 1},
+    # extra keys are not dumped
+    {**PUBLIC_USER, 'password': 'hash'},
+]
+
+
+def assert_parity(schema, obj, many=False, as_str=False):
+    serialize = compile_schema(schema, as_str)
+    compiled = [serialize(o) for o in obj] if many else serialize(obj)
+
+    assert compiled == schema(many=many).dump(obj)
+
+
+@pytest.mark.parametrize('user', USERS)
+def test_public_user(user):
+    assert_parity(PublicUserObject, user)
+
+
+@pytest.mark.parametrize('user', USERS)
+def test_user(user):
+    assert_parity(UserObject, {**user, 'email': 'user1@derailed.one'})
+
+
+def test_user_inherits_public_fields():
+    dumped = compile_schema(UserObject)({**PUBLIC_USER, 'email': 'a@b.c'})
+
+    assert dumped.keys() == PUBLIC_USER.keys() | {'email'}
+
+
+def test_relationships():
+    relationships = [
+        {'type': 0, 'user': PUBLIC_USER},
+        {'type': 2, 'user': {**PUBLIC_USER, 'id': 1}},
+        {'type': 1, 'user': None},
+    ]
+
+    assert_parity(Relationship, relationships, many=True)
+    assert_parity(Relationship, [], many=True)
+
+
+def test_bulk_results():
+    results = [
+        {'user_id': 1, 'action': 'accept', 'status': 204, 'message': None},
+        {'user_id': 2, 'action': 'remove', 'status': 404, 'message': 'Gone'},
+    ]
+
+    assert_parity(BulkResult, results, many=True)
+
+
+@pytest.mark.parametrize(
+    'schema, obj',
+    [
+        (PublicUserObject, {'id': 1, 'username': 'user1'}),
+        (UserObject, {'email': 'a@b.c'}),
+        (Relationship, {'type': 0}),
+        (Relationship, {'type': 0, 'user': {'id': 1}}),
+        (BulkResult, {'user_id': 1, 'status': 204}),
+        (BulkResult, {}),
+    ],
+)
+def test_missing_keys_are_left_out(schema, obj):
+    assert_parity(schema, obj)
+
+
+def test_compiled_once():
+    assert compile_schema(PublicUserObject) is compile_schema(PublicUserObject)
+
+
+@pytest.fixture
+def snowflakes_as_str():
+    app = Flask(__name__)
+    app.config['JSON_SNOWFLAKES_AS_STR'] = True
+
+    with app.app_context():
+        yield
+
+
+@pytest.mark.parametrize('user', USERS)
+def test_snowflakes_as_str(snowflakes_as_str, user):
+    assert_parity(PublicUserObject, user, as_str=True)
+
+    dumped = compile_schema(PublicUserObject, True)(user)
+    assert dumped['id'] == '634334476998057984'
+    # only ids, not every integer
+    assert dumped['flags'] is user['flags']
+
+
+def test_nested_snowflakes_as_str(snowflakes_as_str):
+    relationships = [{'type': 0, 'user': PUBLIC_USER}, {'type': 1, 'user': None}]
+    results = [{'user_id': 1, 'action': 'accept', 'status': 204, 'message': None}]
+
+    assert_parity(Relationship, relationships, many=True, as_str=True)
+    assert_parity(BulkResult, results, many=True, as_str=True)
+    assert compile_schema(BulkResult, True)(results[0])['user_id'] == '1'
+
+
+@pytest.mark.parametrize(
+    'schema, obj',
+    [
+        (Message, {'id': 3, 'channel_id': 2, 'author_id': 1, 'content': 'hi'}),
+        (DMChannel, {'id': 2, 'type': 0, 'recipient_id': None}),
+        (UserChannel, {'id': 2, 'type': 0, 'last_activity': 3}),
+    ],
+)
+def test_channel_snowflakes_as_str(snowflakes_as_str, schema, obj):
+    assert_parity(schema, obj, as_str=True)
+
+
+def test_every_id_is_a_str(snowflakes_as_str):
+    dumped = compile_schema(UserChannel, True)({'id': 2, 'type': 0, 'last_activity': 3})
+
+    assert dumped == {'id': '2', 'type': 0, 'last_activity': '3'}
+
+
+def test_snowflakes_load_from_str():
+    assert Message().load({'id': '3', 'content': 'hi'}, partial=True)['id'] == 3
@@ -0,0 +1,232 @@
+"""
+Copyright 2021-2022 Derailed.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# GCRARateLimiter on memory storage and, through fakeredis, on the Lua
+# script. Both read `time.time`, so one fake clock drives either. Then
+# LocalTierRateLimiter, with workers sharing one memory storage.
+import time
+from unittest import mock
+
+import pytest
+from limits import RateLimitItemPerMinute, RateLimitItemPerSecond
+from limits.storage import MemoryStorage, RedisStorage
+
+from derailedapi.strategies import GCRARateLimiter, LocalTierRateLimiter, gcra
+
+START = 1_700_000_000.0
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = START
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+
+def memory_storage():
+    return MemoryStorage()
+
+
+def redis_storage():
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    client = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+
+    with mock.patch('redis.from_url', lambda *args, **kwargs: client):
+        return RedisStorage('redis://localhost')
+
+
+@pytest.fixture(params=[memory_storage, redis_storage], ids=['memory', 'redis'])
+def storage(request, clock):
+    return request.param()
+
+
+@pytest.fixture
+def limiter(storage):
+    # strategies only keep a weak proxy of their storage
+    return GCRARateLimiter(storage)
+
+
+# 5 a minute, one every 12 seconds
+FIVE_A_MINUTE = RateLimitItemPerMinute(5)
+
+
+def hits(limiter, amount):
+    return [limiter.hit(FIVE_A_MINUTE, 'a') for _ in range(amount)]
+
+
+def test_burst_up_to_amount(limiter):
+    assert hits(limiter, 7) == [True] * 5 + [False] * 2
+
+
+def test_hits_are_spaced_after_a_burst(limiter, clock):
+    for _ in range(5):
+        limiter.hit(FIVE_A_MINUTE, 'a')
+
+    clock.advance(11.9)
+    assert not limiter.hit(FIVE_A_MINUTE, 'a')
+
+    clock.advance(0.1)
+    assert limiter.hit(FIVE_A_MINUTE, 'a')
+    assert not limiter.hit(FIVE_A_MINUTE, 'a')
+
+
+def test_no_second_burst_at_a_window_boundary(limiter, clock):
+    allowed = 0
+
+    # a fixed window would allow 10 around the minute boundary
+    for _ in range(20):
+        allowed += limiter.hit(FIVE_A_MINUTE, 'a')
+        clock.advance(0.5)
+
+    assert allowed == 5
+
+
+def test_keys_are_independent(limiter):
+    for _ in range(5):
+        limiter.hit(FIVE_A_MINUTE, 'a')
+
+    assert not limiter.hit(FIVE_A_MINUTE, 'a')
+    assert limiter.hit(FIVE_A_MINUTE, 'b')
+    assert limiter.hit(RateLimitItemPerSecond(5), 'a')
+
+
+def test_cost(limiter):
+    assert limiter.hit(FIVE_A_MINUTE, 'a', cost=4)
+    assert not limiter.hit(FIVE_A_MINUTE, 'a', cost=2)
+    assert limiter.hit(FIVE_A_MINUTE, 'a')
+
+
+def test_test_does_not_consume(limiter):
+    for _ in range(4):
+        limiter.hit(FIVE_A_MINUTE, 'a')
+
+    assert limiter.test(FIVE_A_MINUTE, 'a')
+    assert limiter.test(FIVE_A_MINUTE, 'a')
+    assert limiter.hit(FIVE_A_MINUTE, 'a')
+    assert not limiter.test(FIVE_A_MINUTE, 'a')
+
+
+def test_stats_of_an_unused_key(limiter):
+    assert limiter.get_window_stats(FIVE_A_MINUTE, 'a') == (START, 5)
+
+
+def test_stats_while_remaining(limiter):
+    limiter.hit(FIVE_A_MINUTE, 'a')
+    limiter.hit(FIVE_A_MINUTE, 'a')
+
+    # fully replenished once both hits are paid off
+    assert limiter.get_window_stats(FIVE_A_MINUTE, 'a') == (START + 24, 3)
+
+
+def test_stats_when_exhausted(limiter, clock):
+    for _ in range(5):
+        limiter.hit(FIVE_A_MINUTE, 'a')
+
+    # the next hit is allowed one interval later
+    assert limiter.get_window_stats(FIVE_A_MINUTE, 'a') == (START + 12, 0)
+
+    clock.advance(12)
+    assert limiter.get_window_stats(FIVE_A_MINUTE, 'a')[1] == 1
+
+
+def test_clear(limiter):
+    for _ in range(5):
+        limiter.hit(FIVE_A_MINUTE, 'a')
+
+    limiter.clear(FIVE_A_MINUTE, 'a')
+
+    assert limiter.get_window_stats(FIVE_A_MINUTE, 'a') == (START, 5)
+    assert hits(limiter, 6) == [True] * 5 + [False]
+
+
+def test_state_expires(limiter, clock):
+    for _ in range(5):
+        limiter.hit(FIVE_A_MINUTE, 'a')
+
+    clock.advance(60)
+    assert hits(limiter, 6) == [True] * 5 + [False]
+
+
+def test_gcra_leaves_tat_alone_when_denied():
+    assert gcra(None, 1000.0, 100.0, 500.0, 1) == (True, 1100.0)
+    # a stale TAT counts from now
+    assert gcra(500.0, 1000.0, 100.0, 500.0, 1) == (True, 1100.0)
+    assert gcra(1400.0, 1000.0, 100.0, 500.0, 1) == (True, 1500.0)
+    assert gcra(1450.0, 1000.0, 100.0, 500.0, 1) == (False, 1450.0)
+    assert gcra(1300.0, 1000.0, 100.0, 500.0, 3) == (False, 1300.0)
+
+
+FIFTY_A_SECOND = RateLimitItemPerSecond(50)
+
+
+@pytest.fixture
+def shared(clock):
+    return MemoryStorage()
+
+
+def workers(storage, count):
+    return [LocalTierRateLimiter(storage) for _ in range(count)]
+
+
+def test_local_fresh_workers_reserve_one_hit(shared):
+    box = workers(shared, 33)
+
+    # a client's requests spread over every worker of a box
+    assert all(w.hit(FIFTY_A_SECOND, 'a') for w in box)
+    assert shared.get(FIFTY_A_SECOND.key_for('a')) == 33
+
+
+@pytest.mark.parametrize('count', [1, 9, 33])
+def test_local_never_admits_over_the_limit(shared, count):
+    box = workers(shared, count)
+    decisions = [box[i % count].hit(FIFTY_A_SECOND, 'a') for i in range(200)]
+
+    assert sum(decisions) == 50
+    # unspent leases would reject early
+    assert decisions.index(False) == 50
+
+
+def test_local_batches_reservations(shared):
+    (worker,) = workers(shared, 1)
+
+    with mock.patch.object(shared, 'incr', wraps=shared.incr) as incr:
+        assert hits_of(worker, 50) == 50
+
+    assert incr.call_count < 25
+    assert not worker.hit(FIFTY_A_SECOND, 'a')
+
+
+def test_local_lease_expires_with_the_window(shared, clock):
+    (worker,) = workers(shared, 1)
+    hits_of(worker, 50)
+
+    clock.advance(1)
+    assert worker.hit(FIFTY_A_SECOND, 'a')
+
+
+def hits_of(worker, amount):
+    return sum(worker.hit(FIFTY_A_SECOND, 'a') for _ in range(amount))